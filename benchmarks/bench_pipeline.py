@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""End-to-end latency benchmark of the analysis pipeline, run offline.
+
+Synthetic sales datasets (10k to 50M rows) go through the same stages as
+a question in the apps: ingestion, profiling, column index, prompt build, code
+generation, execution, explanation and render. The model is the local
+`model_backend.StubModel`, which replays recorded code and explanations
+with fixed delays, so timings only move when the pipeline itself changes.
+
+For every stage the wall time and the peak RSS growth over the stage are
+reported. Results can be written as JSON and compared against a previous
+run to catch regressions:
+
+    python benchmarks/bench_pipeline.py --rows 10k,1m --json base.json
+    python benchmarks/bench_pipeline.py --rows 10k,1m --baseline base.json
+
+The dataset store and caches live in a temporary directory, so every run
+starts cold and leaves nothing behind; a directory given in
+CHAT_WITH_DATA_BENCH_DIR is used instead and kept.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Spawned workers re-import this module and reuse the parent's directory;
+# only the process that created it removes it
+if "CHAT_WITH_DATA_BENCH_DIR" not in os.environ:
+    os.environ["CHAT_WITH_DATA_BENCH_DIR"] = tempfile.mkdtemp(prefix="chat-with-data-bench-")
+    atexit.register(shutil.rmtree, os.environ["CHAT_WITH_DATA_BENCH_DIR"], ignore_errors=True)
+_WORK_DIR = os.environ["CHAT_WITH_DATA_BENCH_DIR"]
+os.environ.setdefault("CHAT_WITH_DATA_STORE", os.path.join(_WORK_DIR, "store"))
+os.environ.setdefault("CHAT_WITH_DATA_CODE_CACHE", os.path.join(_WORK_DIR, "code_cache.sqlite3"))
+os.environ.setdefault("CHAT_WITH_DATA_RESULT_CACHE", os.path.join(_WORK_DIR, "result_cache"))
+# The stub model has no quota; a rate limit would only time the scheduler's waits
+os.environ.setdefault("CHAT_WITH_DATA_LLM_RATE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import pyarrow as pa  # noqa: E402
+
+import code_analysis  # noqa: E402
+import execution  # noqa: E402
+import ingestion  # noqa: E402
+import llm  # noqa: E402
+import model_backend  # noqa: E402
+import prompt_builder  # noqa: E402
+import result_digest  # noqa: E402
+import worker_pool  # noqa: E402
+
+STAGES = ["ingest", "profile", "index", "prompt", "generate", "exec", "explain", "render"]
+DEFAULT_ROWS = "10k,100k,1m"
+ALL_ROWS = "10k,100k,1m,10m,50m"
+GENERATE_CHUNK_ROWS = 1_000_000
+SAMPLE_SECONDS = 0.005
+
+REGIONS = ["North", "South", "East", "West", "Central"]
+PRODUCTS = [f"P{i:03d}" for i in range(200)]
+
+RECORDINGS = [
+    model_backend.Recording(
+        question="Total sales by region",
+        code="ANSWER = df.groupby('region', observed=True)['sales'].sum().sort_values(ascending=False)",
+        explanation="Sales are spread across the five regions; the table lists them from highest to lowest.",
+    ),
+    model_backend.Recording(
+        question="Top 10 products by quantity",
+        code="ANSWER = df.groupby('product', observed=True)['quantity'].sum().nlargest(10)",
+        explanation="These ten products sold the most units over the whole period.",
+    ),
+    model_backend.Recording(
+        question="Monthly average price",
+        code="ANSWER = df.groupby(pd.to_datetime(df['order_date']).dt.to_period('M'))['price'].mean()",
+        explanation="The average price stays close to the same level from month to month.",
+    ),
+]
+QUESTIONS = [recording.question for recording in RECORDINGS]
+
+
+class UploadedFile:
+    """The part of Streamlit's UploadedFile that `ingestion.load_csv` uses."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux: fall back to the lifetime peak, which only ever grows
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakSampler:
+    """Samples RSS on a background thread to find a stage's peak growth."""
+
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self.started = time.perf_counter()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_SECONDS):
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+        self.peak_delta_bytes = self.peak_bytes - self.start_bytes
+
+
+def parse_rows(text):
+    units = {"k": 1_000, "m": 1_000_000}
+    rows = []
+    for item in text.split(","):
+        item = item.strip().lower()
+        rows.append(int(float(item[:-1]) * units[item[-1]]) if item[-1] in units else int(item))
+    return rows
+
+
+def write_dataset(path, rows, seed=0):
+    """Write a synthetic sales CSV chunk by chunk, so 50M rows fit in memory."""
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2023-01-01")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for offset in range(0, rows, GENERATE_CHUNK_ROWS):
+            n = min(GENERATE_CHUNK_ROWS, rows - offset)
+            quantity = rng.integers(1, 20, n)
+            price = rng.uniform(10, 500, n).round(2)
+            chunk = pd.DataFrame({
+                "order_id": np.arange(offset, offset + n),
+                "order_date": (start + rng.integers(0, 730, n).astype("timedelta64[D]")).astype(str),
+                "region": rng.choice(REGIONS, n),
+                "product": rng.choice(PRODUCTS, n),
+                "customer_age": rng.integers(18, 80, n),
+                "quantity": quantity,
+                "price": price,
+                "sales": (quantity * price).round(2),
+            })
+            chunk.to_csv(f, index=False, header=offset == 0)
+
+
+def render(answer):
+    """What the apps do to show an ANSWER: Arrow for st.dataframe plus its digest."""
+    if isinstance(answer, pd.DataFrame):
+        pa.Table.from_pandas(answer.head(10))
+    elif isinstance(answer, pd.Series):
+        pa.Table.from_pandas(answer.head(10).to_frame())
+    return result_digest.digest(answer)
+
+
+def run_question(question, handle, index, model, pool, measure):
+    with measure("prompt"):
+        code_prompt = prompt_builder.build_code_prompt(question, index).text
+    with measure("generate"):
+        code = code_analysis.gate(code_analysis.clean_generated_code(llm.generate_text(model, code_prompt))).code
+    with measure("exec"):
+        local_vars, _ = pool.run(code, handle)
+    with measure("render"):
+        answer_text = render(local_vars.get("ANSWER"))
+    with measure("explain"):
+        stream = llm.TextStream(model, f'The user asked: "{question}",\nHere is the result:\n{answer_text}')
+        for _ in stream:
+            pass
+
+
+def bench_size(rows, model, pool, repeat):
+    """Per-stage timings for one dataset size; question stages are per question.
+
+    Profiling and the column index are measured once, cold: later questions
+    only hit their caches.
+    """
+    results = {stage: {"seconds": [], "peak_delta_bytes": []} for stage in STAGES}
+
+    class measure(PeakSampler):
+        def __init__(self, stage):
+            self.stage = stage
+
+        def __exit__(self, *exc_info):
+            super().__exit__(*exc_info)
+            results[self.stage]["seconds"].append(self.seconds)
+            results[self.stage]["peak_delta_bytes"].append(self.peak_delta_bytes)
+
+    path = os.path.join(_WORK_DIR, f"sales_{rows}.csv")
+    write_dataset(path, rows)
+    upload = UploadedFile(os.path.basename(path), path)
+    with measure("ingest"):
+        handle = ingestion.load_csv(upload).handle
+    os.remove(path)
+    with measure("profile"):
+        profile = ingestion.get_profile(handle)
+    with measure("index"):
+        index = prompt_builder.column_index(handle.content_hash, profile)
+
+    for _ in range(repeat):
+        for question in QUESTIONS:
+            run_question(question, handle, index, model, pool, measure)
+
+    summary = {}
+    for stage, values in results.items():
+        if values["seconds"]:
+            summary[stage] = {
+                "seconds": float(np.median(values["seconds"])),
+                "peak_delta_bytes": int(max(values["peak_delta_bytes"])),
+            }
+    return summary
+
+
+def print_header():
+    print(f"{'rows':>12} " + " ".join(f"{stage:>18}" for stage in STAGES))
+
+
+def print_row(rows, stages):
+    """One line per size: median time / peak RSS growth for each stage."""
+    cells = []
+    for stage in STAGES:
+        if stage in stages:
+            cell = f"{stages[stage]['seconds'] * 1000:,.1f}ms/{stages[stage]['peak_delta_bytes'] / 1024**2:,.0f}MB"
+        else:
+            cell = "-"
+        cells.append(f"{cell:>18}")
+    print(f"{rows:>12,} " + " ".join(cells), flush=True)
+
+
+def compare(report, baseline, tolerance):
+    """Stages slower than the baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    for rows, stages in report.items():
+        for stage, values in stages.items():
+            before = baseline.get(rows, {}).get(stage)
+            # Sub-millisecond stages are too noisy to compare
+            if before is None or before["seconds"] < 0.001:
+                continue
+            if values["seconds"] > before["seconds"] * (1 + tolerance):
+                regressions.append(f"{int(rows):,} rows / {stage}: {before['seconds']:.4f}s -> {values['seconds']:.4f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", default=DEFAULT_ROWS, help=f"comma-separated sizes, e.g. {ALL_ROWS}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each question; medians are reported")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for exec (0 runs in-process, so exec memory is measured)")
+    parser.add_argument("--latency", type=float, default=0.0, help="stub model delay before the first chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="stub model delay between chunks")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results written by an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    execution.enable_copy_on_write()
+    model = model_backend.StubModel(RECORDINGS, latency_seconds=args.latency, chunk_seconds=args.chunk_delay)
+    pool = worker_pool.WorkerPool(size=args.workers)
+    report = {}
+    print_header()
+    try:
+        for rows in parse_rows(args.rows):
+            report[str(rows)] = bench_size(rows, model, pool, args.repeat)
+            print_row(rows, report[str(rows)])
+    finally:
+        pool.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
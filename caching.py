@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Small in-process caches shared by the chat-with-data apps.
+
+Streamlit re-imports the app script on every rerun but keeps imported
+modules alive, so a module-level cache here lives for the whole server
+process and is shared by every session.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by entry count and optionally by size.
+
+    `sizeof` returns the weight of a value (usually bytes); when `max_bytes`
+    is set the least recently used entries are evicted until the total
+    weight fits again. `on_evict(key, value)` is called for each eviction.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, sizeof=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._on_evict = on_evict
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Return a value without touching recency or the hit counters."""
+        with self._lock:
+            return self._data.get(key, default)
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            size = self._sizeof(value)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key]
+            self._remove(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        del self._data[key]
+        self.total_bytes -= self._sizes.pop(key, 0)
+
+    def _evict(self):
+        while len(self._data) > self.max_entries or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._data) > 1
+        ):
+            oldest = next(iter(self._data))
+            value = self._data[oldest]
+            self._remove(oldest)
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(oldest, value)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Bounded chat history with compact entries.
+
+The history used to be a plain list of (role, text) that grew without
+bound and stored `str(ANSWER)`, which for a large result is megabytes, and
+every rerun rendered all of it. Entries are now capped in number and
+length. A result is stored as a short digest plus a reference to the
+memoized ANSWER in `result_cache`, from which the full value is loaded
+only on request. Only the most recent messages are rendered by default;
+older ones are reachable a page at a time, so the render cost per rerun
+does not grow with the session.
+"""
+
+import os
+from collections import deque
+from dataclasses import dataclass
+
+import result_cache
+import result_digest
+
+MAX_ENTRIES = int(os.environ.get("CHAT_WITH_DATA_HISTORY_ENTRIES", 200))
+MAX_MESSAGE_CHARS = 8000
+# Messages rendered on every rerun; older ones are paged
+RECENT_MESSAGES = 12
+PAGE_SIZE = 20
+
+
+def compact_text(text, limit=MAX_MESSAGE_CHARS):
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}… ({len(text) - limit:,} more characters)"
+
+
+def result_preview(answer):
+    """Short digest of an ANSWER for the history."""
+    return result_digest.digest(answer, result_digest.PREVIEW_TOKENS)
+
+
+@dataclass(frozen=True)
+class ResultRef:
+    """Where the full ANSWER lives in the result cache."""
+
+    code: str
+    dataset_hash: str
+
+    def load(self):
+        """The full ANSWER, or `result_cache.MISSING` once it was evicted."""
+        return result_cache.default_cache().get(self.code, self.dataset_hash)
+
+
+@dataclass(frozen=True)
+class Entry:
+    seq: int
+    role: str
+    text: str
+    result: ResultRef = None
+
+
+class ChatHistory:
+    """The last `max_entries` messages of a session."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._entries = deque(maxlen=max_entries)
+        # Sequence numbers stay unique after old entries are dropped (widget keys)
+        self._next_seq = 0
+        self.dropped = 0
+
+    def append(self, role, text, result=None):
+        """Add a message; `result` is the ResultRef of a full ANSWER, if any."""
+        if len(self._entries) == self._entries.maxlen:
+            self.dropped += 1
+        self._entries.append(Entry(self._next_seq, role, compact_text(text), result))
+        self._next_seq += 1
+
+    def recent(self, count=RECENT_MESSAGES):
+        return list(self._entries)[-count:] if count else []
+
+    def older_pages(self, recent=RECENT_MESSAGES, page_size=PAGE_SIZE):
+        """Number of pages of messages before the `recent` ones."""
+        older = max(0, len(self._entries) - recent)
+        return -(-older // page_size)
+
+    def older_page(self, page, recent=RECENT_MESSAGES, page_size=PAGE_SIZE):
+        """Page `page` (0 = the oldest) of the messages before the `recent` ones."""
+        older = max(0, len(self._entries) - recent)
+        start = page * page_size
+        return [self._entries[i] for i in range(start, min(start + page_size, older))]
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
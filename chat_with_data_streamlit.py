@@ -9,175 +9,496 @@ Original file is located at
 
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
+import queue
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import chat_history
+import code_analysis
+import code_cache
+import context_builder
+import cubes
+import data_dictionary
+import dataset_registry
+import dataset_store
+import execution
+import export
+import ingestion
+import llm
+import model_backend
+import perf
+import prompt_builder
+import result_cache
+import result_digest
+import sampling
+import scheduler
+import sql_engine
+import worker_pool
+
+execution.enable_copy_on_write()
 
 # Gemini API Setup
 try:
-    key = st.secrets['gemini_api_key']
-    genai.configure(api_key=key)
-    model = genai.GenerativeModel('gemini-2.0-flash-lite')
+    # Gemini by default; CHAT_WITH_DATA_MODEL_BACKEND=stub replays recorded responses
+    model = model_backend.create_model(st.secrets)
     api_configured = True
 except Exception as e:
     st.error(f"Failed to configure Gemini API: {e}")
     api_configured = False
 
+# Worker processes for generated code, shared by all sessions
+@st.cache_resource
+def get_worker_pool():
+    return worker_pool.WorkerPool()
+
+# Which sessions use which datasets, shared by all sessions
+@st.cache_resource
+def get_dataset_registry():
+    return dataset_registry.DatasetRegistry()
+
 # Set up the Streamlit app layout
 st.title("My Chatbot and Data Analysis App")
 
 # Initialize session state
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    st.session_state.chat_history = chat_history.ChatHistory()
 if "uploaded_data" not in st.session_state:
     st.session_state.uploaded_data = []
 if "data_context" not in st.session_state:
-    st.session_state.data_context = ""
+    st.session_state.data_context = context_builder.DataContext()
 if "data_dictionary" not in st.session_state:
     st.session_state.data_dictionary = None
+if "dictionary_index" not in st.session_state:
+    st.session_state.dictionary_index = None
+if "perf_traces" not in st.session_state:
+    st.session_state.perf_traces = perf.TraceBuffer()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Upload CSV Files
 st.subheader("Upload CSV Files for Analysis")
 uploaded_files = st.file_uploader("Choose one or more CSV files", type=["csv"], accept_multiple_files=True)
+# Files removed from the uploader leave the session too
+st.session_state.uploaded_data = []
 if uploaded_files:
-    all_contexts = []
-    st.session_state.uploaded_data = []
     for file in uploaded_files:
         try:
-            df = pd.read_csv(file)
-            st.session_state.uploaded_data.append((file.name, df))
+            # Parsed frames and their context are cached by content hash,
+            # so reruns (every chat message) skip re-reading the CSV
+            progress_slot = st.empty()
+            # Only kept when something was actually parsed or profiled
+            upload_trace = perf.RequestTrace(f"upload {file.name}", kind="upload")
+            ingested = ingestion.load_csv(
+                file,
+                progress=lambda fraction: progress_slot.progress(fraction, text=f"Reading {file.name}..."),
+                trace=upload_trace,
+            )
+            progress_slot.empty()
+            ingestion.get_profile(ingested.handle, upload_trace)
+            # Large files get a sample once, reused by every question in progressive mode
+            sampling.ensure_sample(ingested.handle, upload_trace)
+            # Cubes for group-by questions are built on a background thread
+            cubes.schedule_build(ingested.handle)
+            st.session_state.perf_traces.record(upload_trace)
+            df = ingested.df
+            # Only the store handle is kept per session; data is memory-mapped
+            st.session_state.uploaded_data.append((file.name, ingested.handle))
             st.success(f"File '{file.name}' uploaded and read.")
             st.write(f"### Preview of {file.name}")
             st.dataframe(df.head())
-
-            description = df.describe(include='all').to_string()
-            sample_rows = df.head(3).to_string(index=False)
-            columns_info = "\n".join([f"- {col}: {dtype}" for col, dtype in zip(df.columns, df.dtypes)])
-            file_context = (
-                f"File: {file.name}\n"
-                f"Columns and Types:\n{columns_info}\n\n"
-                f"Descriptive Statistics:\n{description}\n\n"
-                f"Sample Records:\n{sample_rows}\n"
-            )
-            all_contexts.append(file_context)
+            if ingested.report is not None:
+                st.caption(f"Compact ingestion: {ingested.report.summary()}")
 
         except Exception as e:
             st.error(f"An error occurred while reading file '{file.name}': {e}")
 
-    st.session_state.data_context = (
-        "You are a helpful data analyst AI. The user uploaded multiple datasets. Here is the context for each:\n\n"
-        + "\n\n".join(all_contexts)
+    cache_stats = ingestion.cache_stats()
+    st.caption(f"Ingestion cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+    code_stats = code_cache.default_cache().stats()
+    st.caption(
+        f"Generated-code cache: {code_stats['hits']} hits / {code_stats['misses']} misses "
+        f"({code_stats['hit_rate']:.0%} hit rate, {code_stats['entries']} stored)"
     )
+    st.caption(f"Code analysis: {code_analysis.stats_summary()}")
+    st.caption(f"Model requests: {scheduler.default_scheduler().summary()}")
+    st.caption(f"Aggregate cubes: {cubes.summary()}")
+
+# Renew this session's leases; identical uploads of all sessions share one dataset
+registry = get_dataset_registry()
+registry.sync(st.session_state.session_id, st.session_state.uploaded_data)
+# Only segments of added files are built; removed files drop theirs
+st.session_state.data_context.sync_datasets(st.session_state.uploaded_data)
+with st.expander(f"Server memory: {registry.summary()}"):
+    registry_rows = registry.snapshot()
+    if registry_rows:
+        st.dataframe(pd.DataFrame(registry_rows).set_index("dataset"))
+    else:
+        st.write("No datasets in use.")
 
 # Upload Data Dictionary
 st.subheader("Upload Data Dictionary")
 dict_file = st.file_uploader("Choose a CSV data dictionary file", type=["csv"], key="dict_file")
 if dict_file is not None:
     try:
-        data_dict = pd.read_csv(dict_file)
+        ingested_dict = ingestion.load_csv(dict_file)
+        data_dict = ingested_dict.df
         st.session_state.data_dictionary = data_dict
+        # Parsed and indexed once per dictionary; questions are looked up against it
+        st.session_state.dictionary_index = data_dictionary.load(ingested_dict.content_hash, data_dict)
         st.success("Data dictionary successfully uploaded and read.")
         st.write("### Data Dictionary Preview")
         st.dataframe(data_dict)
-        dict_info = data_dict.to_string(index=False)
-        st.session_state.data_context += f"\n\nData Dictionary:\n{dict_info}"
+        # Replaces the previous dictionary segment instead of appending on every rerun
+        st.session_state.data_context.set_dictionary(ingested_dict.content_hash, data_dict)
     except Exception as e:
         st.error(f"An error occurred while reading the data dictionary file: {e}")
+else:
+    st.session_state.data_context.clear_dictionary()
+
+# The full result as a file; it is written in chunks on disk, never built as one string
+def render_download(entry):
+    fmt = st.selectbox("Format", list(export.FORMATS), key=f"export_format_{entry.seq}")
+    key = export.export_key(entry.result.code, entry.result.dataset_hash, fmt)
+    prepared = export.get(key)
+    if prepared is None:
+        answer = entry.result.load()
+        if answer is result_cache.MISSING:
+            st.caption("The full result is no longer cached; ask the question again to recompute it.")
+            return
+        try:
+            with st.spinner(f"Writing {fmt} file..."):
+                prepared = export.prepare(answer, fmt, key)
+        except export.ExportError as e:
+            st.error(str(e))
+            return
+    st.caption(f"Export: {prepared.summary()}")
+    url = export.static_url(prepared) if st.get_option("server.enableStaticServing") else None
+    if url is not None:
+        # Streamed from disk by Streamlit's static file server
+        st.markdown(
+            f'<a href="{url}" download="{prepared.file_name}">Download {prepared.file_name}</a>',
+            unsafe_allow_html=True,
+        )
+    elif prepared.size_bytes <= export.MAX_INLINE_BYTES:
+        # download_button keeps the whole file in server memory
+        with open(prepared.path, "rb") as f:
+            st.download_button(
+                f"Download {prepared.file_name}", data=f, file_name=prepared.file_name, mime=prepared.mime,
+                key=f"export_download_{entry.seq}",
+            )
+    else:
+        st.warning(
+            f"Files over {export.MAX_INLINE_BYTES / 1024**2:,.0f} MB can only be downloaded with static file "
+            "serving enabled (server.enableStaticServing in .streamlit/config.toml)."
+        )
 
-# Show chat history BELOW the checkbox
-for role, message in st.session_state.chat_history:
-    st.chat_message(role).markdown(message)
+# A history message; a stored result's full value is loaded from the result cache on request
+def render_entry(entry):
+    with st.chat_message(entry.role):
+        st.markdown(entry.text)
+        if entry.result is not None and st.checkbox("Show full result", key=f"full_result_{entry.seq}"):
+            answer = entry.result.load()
+            if answer is result_cache.MISSING:
+                st.caption("The full result is no longer cached; ask the question again to recompute it.")
+            elif isinstance(answer, pd.DataFrame):
+                st.dataframe(answer)
+            else:
+                st.write(answer)
+        if entry.result is not None and st.checkbox("Download full result", key=f"download_result_{entry.seq}"):
+            render_download(entry)
 
-# Handle user input & AI response
-if user_input := st.chat_input("พิมพ์คำถามที่ต้องการได้เลยครับ"):
-    st.session_state.chat_history.append(("user", user_input))
-    st.chat_message("user").markdown(user_input)
+# Optional engine mode: one DuckDB SQL query over all uploads, so questions can join files
+st.checkbox(
+    "SQL engine mode (DuckDB): answer with one SQL query across all uploaded files",
+    key="sql_mode",
+    disabled=not sql_engine.available(),
+    help="Tables are named after the files. Requires the duckdb package."
+)
+# Progressive mode: large files answer from their sample first, then from all rows
+st.checkbox(
+    "Progressive mode: on large files, show an approximate result from a sample first",
+    value=True,
+    key="progressive_mode",
+    help=f"Applies to files of at least {sampling.PROGRESSIVE_MIN_ROWS:,} rows."
+)
 
-    if api_configured:
-        if st.session_state.uploaded_data:
-            for file_name, df in st.session_state.uploaded_data:
-                df_name = "df"
-                example_record = df.head(2).to_string(index=False)
-                data_dict_text = "\n".join([f"{col}: {dtype}" for col, dtype in zip(df.columns, df.dtypes)])
-                question = user_input
-
-                # Prompt for code generation
-                code_prompt = f"""
-You are a helpful Python code generator.
-Your goal is to write Python code snippets based on the user's question and the provided DataFrame information.
-Here's the context:
-**User Question:**
-{question}
-**DataFrame Name:**
-{df_name}
-**DataFrame Details:**
-{data_dict_text}
-**Sample Data (Top 2 Rows):**
-{example_record}
-
-**Instructions:**
-1. Write Python code that addresses the user's question by querying or manipulating the DataFrame.
-2. **Use the `exec()` function to execute the generated code.**
-3. Do not import pandas, but you may assume `pd` (pandas) is already available.
-4. Change date column type to datetime if needed.
-5. Store the result in a variable named `ANSWER`.
-6. Assume the DataFrame is already loaded into a pandas DataFrame object named `{df_name}`.
-7. Keep the generated code concise and focused on answering the question.
-8. If the question requires a specific output format (e.g., a list, a single value), ensure the `ANSWER` variable holds that format.
-
-**Example:**
-If the user asks: "Show me the rows where the 'age' column is greater than 30."
-And the DataFrame has an 'age' column.
-The generated code should look something like this:
-```python
-ANSWER = {df_name}[{df_name}['age'] > 30]
-```
-"""
+# Show chat history BELOW the checkbox. Only the latest messages render on
+# every rerun; earlier ones are shown a page at a time on request
+history = st.session_state.chat_history
+older_pages = history.older_pages()
+if older_pages and st.checkbox(f"Show earlier messages ({len(history) - chat_history.RECENT_MESSAGES} more)", key="show_older_messages"):
+    page = st.number_input("Page (1 = oldest)", min_value=1, max_value=older_pages, value=older_pages, key="history_page")
+    for entry in history.older_page(page - 1):
+        render_entry(entry)
+for entry in history.recent():
+    render_entry(entry)
 
-                try:
-                    response = model.generate_content(code_prompt)
-                    generated_code = response.text
-
-                    # Clean the code and execute it
-                    cleaned_code = generated_code.strip().replace("```python", "").replace("```", "")
-                    local_vars = {df_name: df.copy(), "pd": pd}
-                    exec(cleaned_code, {}, local_vars)
-
-                    # Check if ANSWER variable exists in the local variables
-                    if "ANSWER" not in local_vars:
-                        st.warning("The generated code did not create an ANSWER variable. Here's the generated code:")
-                        st.code(cleaned_code)
-                        answer_result = "No result in variable ANSWER"
-                    else:
-                        answer_result = local_vars["ANSWER"]
-
-                        # Display result based on type
-                        if isinstance(answer_result, pd.DataFrame):
-                            st.dataframe(answer_result.head(10))
-                        else:
-                            st.write(answer_result)
+# Files analyzed at once per question; the API limit is enforced in llm.py
+MAX_CONCURRENT_FILES = 4
+
+# Per-file pipeline (code generation -> execution -> explanation). It makes no
+# st.* calls so that several files can be analyzed on worker threads at once;
+# progress is reported to the script thread as (kind, index, payload) events:
+# "preview" with an approximate ANSWER from the sample (progressive mode),
+# "answer" when ANSWER is ready, "chunk" per streamed explanation chunk, "done".
+# Stage timings go to the question's shared perf trace.
+def new_result(file_name):
+    return {"file_name": file_name, "cleaned_code": None, "answer_ready": False, "has_answer": False,
+            "answer": None, "result_ref": None, "exec_stats": None, "explanation": None,
+            "explanation_timing": "", "error": None}
 
-                    st.session_state.chat_history.append(("assistant", f"**Result:**\n{str(answer_result)}"))
+# Report the ANSWER, then stream its explanation as "chunk" events
+def explain_answer(index, question, answer_result, result, events, trace, label):
+    result["answer"] = answer_result
+    result["answer_ready"] = True
+    events.put(("answer", index, result))
 
-                    # Prompt for explanation
-                    explain_prompt = f'''
+    # Prompt for explanation, with a bounded digest of the result instead of str(ANSWER)
+    explain_prompt = f'''
 The user asked: "{question}",
-Here is the result:\n{str(answer_result)}
+Here is the result:\n{result_digest.digest(answer_result)}
 Answer the question and summarize the findings,
 Include your opinion of the persona of this customer if relevant.
 '''
-                    explain_response = model.generate_content(explain_prompt)
-                    explanation_text = explain_response.text
-                    st.session_state.chat_history.append(("assistant", explanation_text))
-                    st.chat_message("assistant").markdown(f"**Summary & Interpretation:**\n{explanation_text}")
-
-                except Exception as e:
-                    error_msg = f"⚠️ An error occurred during code execution: {e}\n\n{traceback.format_exc()}"
-                    st.error(error_msg)
-                    st.session_state.chat_history.append(("assistant", error_msg))
-                    st.chat_message("assistant").markdown(error_msg)
+    stream = llm.TextStream(model, explain_prompt)
+    with trace.span("explain", label):
+        for text in stream:
+            events.put(("chunk", index, text))
+    result["explanation"] = stream.text
+    result["explanation_timing"] = stream.timing_summary()
+
+def analyze_file(index, file_name, handle, question, pool, events, dictionary, trace, progressive=False, job=None):
+    result = new_result(file_name)
+    try:
+        df = dataset_store.open_dataframe(handle)
+        df_name = "df"
+        data_dict_text = "\n".join([f"{col}: {dtype}" for col, dtype in zip(df.columns, df.dtypes)])
+
+        # Prompt for code generation: only the columns relevant to the question,
+        # within the token budget, ranked from the cached profile and dictionary
+        profile = ingestion.get_profile(handle, trace)
+        with trace.span("prompt", file_name):
+            columns_index = prompt_builder.column_index(handle.content_hash, profile)
+            code_prompt = prompt_builder.build_code_prompt(
+                question, columns_index, df_name, include_example=True, dictionary=dictionary
+            ).text
+
+        # Reuse code that already answered this question on the same schema
+        schema_fingerprint = code_cache.schema_fingerprint(data_dict_text)
+        cleaned_code = code_cache.default_cache().get(question, schema_fingerprint)
+        code_from_cache = cleaned_code is not None
+        if not code_from_cache:
+            with trace.span("generate", file_name):
+                generated_code = llm.generate_text(model, code_prompt)
+                # Vectorize slow row-wise patterns, or regenerate once without them
+                analysis = code_analysis.gate(
+                    code_analysis.clean_generated_code(generated_code),
+                    regenerate=lambda feedback: llm.generate_text(model, code_prompt + feedback),
+                )
+            cleaned_code = analysis.code
+        result["cleaned_code"] = cleaned_code
+        # Identical code on identical data returns the memoized ANSWER
+        cached_answer = result_cache.default_cache().get(cleaned_code, handle.content_hash)
+        if cached_answer is not result_cache.MISSING:
+            local_vars = {"ANSWER": cached_answer}
+        else:
+            # Group-by aggregates over low-cardinality columns come from the cubes
+            # built after upload, without scanning the dataset
+            cube_hit = cubes.answer(cleaned_code, handle, df_name)
+            if cube_hit is not None:
+                local_vars, result["exec_stats"] = {"ANSWER": cube_hit.answer}, cube_hit
+            else:
+                # Progressive mode: a quick approximate ANSWER from the sample first
+                # in a thread of its own, while the full run below starts right away
+                sample = sampling.get_sample(handle) if progressive else None
+                preview_job = None
+                if sample is not None:
+                    preview_job = sampling.start_preview(
+                        pool, cleaned_code, sample,
+                        lambda answer, stats: events.put(("preview", index, (answer, stats, sample.label()))),
+                        df_name, trace, f"{file_name} (sample)",
+                    )
+                # Runs in a prewarmed worker process with a timeout and memory cap;
+                # the code gets a copy-on-write view, not a deep copy of the dataset
+                try:
+                    with trace.span("exec", file_name):
+                        local_vars, result["exec_stats"] = pool.run(cleaned_code, handle, df_name, job=job)
+                finally:
+                    # A sample run still going would hold a worker other files need
+                    if preview_job is not None:
+                        preview_job.cancel()
+            if "ANSWER" in local_vars:
+                result_cache.default_cache().put(cleaned_code, handle.content_hash, local_vars["ANSWER"])
+        if not code_from_cache and "ANSWER" in local_vars:
+            code_cache.default_cache().put(question, schema_fingerprint, cleaned_code)
+
+        # Check if ANSWER variable exists in the local variables
+        if "ANSWER" not in local_vars:
+            answer_result = "No result in variable ANSWER"
+        else:
+            answer_result = local_vars["ANSWER"]
+            result["has_answer"] = True
+            result["result_ref"] = chat_history.ResultRef(cleaned_code, handle.content_hash)
+        explain_answer(index, question, answer_result, result, events, trace, file_name)
+
+    except Exception as e:
+        result["error"] = f"⚠️ An error occurred during code execution: {e}\n\n{traceback.format_exc()}"
+    finally:
+        events.put(("done", index, result))
+    return result
+
+# SQL engine mode: one DuckDB query over every uploaded file, reported like a single file
+SQL_LABEL = "All uploaded files (SQL)"
+
+def analyze_sql(index, files, question, events, dictionary, trace):
+    result = new_result(SQL_LABEL)
+    try:
+        sql_answer = sql_engine.answer_question(question, files, model, dictionary, trace)
+        result["cleaned_code"] = sql_answer.sql
+        result["exec_stats"] = sql_answer.stats
+        result["has_answer"] = True
+        result["result_ref"] = chat_history.ResultRef(sql_answer.sql, sql_answer.dataset_hash)
+        explain_answer(index, question, sql_answer.answer, result, events, trace, "sql")
+
+    except Exception as e:
+        result["error"] = f"⚠️ An error occurred while running the SQL query: {e}"
+        if result["cleaned_code"] is None:
+            result["error"] += f"\n\n{traceback.format_exc()}"
+    finally:
+        events.put(("done", index, result))
+    return result
+
+# Render an approximate ANSWER from a sample into a slot the full ANSWER clears
+def render_preview(slot, payload):
+    answer, stats, label = payload
+    with slot.container():
+        st.info(label)
+        if isinstance(answer, pd.DataFrame):
+            st.dataframe(answer.head(10))
+        else:
+            st.write(answer)
+        st.caption(f"Sample execution: {stats.summary()}")
+
+# Render a file's ANSWER; returns an empty slot for the streamed explanation
+def render_answer(result):
+    answer_result = result["answer"]
+    if not result["has_answer"]:
+        st.warning("The generated code did not create an ANSWER variable. Here's the generated code:")
+        st.code(result["cleaned_code"])
+    else:
+        # Display result based on type
+        if isinstance(answer_result, pd.DataFrame):
+            st.dataframe(answer_result.head(10))
+        else:
+            st.write(answer_result)
+        if result["exec_stats"] is not None:
+            st.caption(f"Execution: {result['exec_stats'].summary()}")
+        if result["file_name"] == SQL_LABEL:
+            with st.expander("SQL query"):
+                st.code(result["cleaned_code"], language="sql")
+    return st.chat_message("assistant").empty()
+
+# Handle user input & AI response
+if user_input := st.chat_input("พิมพ์คำถามที่ต้องการได้เลยครับ"):
+    st.session_state.chat_history.append("user", user_input)
+    st.chat_message("user").markdown(user_input)
+
+    if api_configured:
+        if st.session_state.uploaded_data:
+            files = list(st.session_state.uploaded_data)
+            pool = get_worker_pool()
+            dictionary = st.session_state.dictionary_index
+            trace = perf.RequestTrace(user_input)
+            # SQL mode answers with one query over all files, otherwise each file is analyzed
+            sql_mode = st.session_state.get("sql_mode", False) and sql_engine.available()
+            progressive = st.session_state.get("progressive_mode", True)
+            labels = [SQL_LABEL] if sql_mode else [file_name for file_name, _ in files]
+            # One container per file keeps the output order stable while files
+            # finish in any order
+            slots = [st.container() for _ in labels]
+            status = []
+            for slot, label in zip(slots, labels):
+                with slot:
+                    status.append(st.empty())
+                    status[-1].info(f"Analyzing {label}...")
+            preview_slots = [None] * len(labels)
+            # A sample preview that arrives after the full answer is dropped
+            answered = [False] * len(labels)
+            explanation_slots = [None] * len(labels)
+            explanations = [""] * len(labels)
+            file_messages = [[] for _ in labels]
+            events = queue.Queue()
+            # Cancelled when the script is stopped or rerun, so workers do not keep
+            # running a superseded question until the timeout
+            jobs = [worker_pool.Job() for _ in labels]
+            with ThreadPoolExecutor(max_workers=min(len(labels), MAX_CONCURRENT_FILES)) as executor:
+                if sql_mode:
+                    executor.submit(analyze_sql, 0, files, user_input, events, dictionary, trace)
+                else:
+                    for idx, (file_name, handle) in enumerate(files):
+                        executor.submit(
+                            analyze_file, idx, file_name, handle, user_input, pool, events, dictionary, trace, progressive,
+                            jobs[idx],
+                        )
+                try:
+                    remaining = len(labels)
+                    while remaining:
+                        kind, idx, payload = events.get()
+                        if kind == "preview":
+                            if answered[idx]:
+                                continue
+                            status[idx].info(f"Analyzing all rows of {labels[idx]}...")
+                            with slots[idx]:
+                                preview_slots[idx] = st.empty()
+                            render_preview(preview_slots[idx], payload)
+                        elif kind == "answer":
+                            answered[idx] = True
+                            status[idx].empty()
+                            if preview_slots[idx] is not None:
+                                preview_slots[idx].empty()
+                            with slots[idx], trace.span("render", labels[idx]):
+                                explanation_slots[idx] = render_answer(payload)
+                        elif kind == "chunk":
+                            explanations[idx] += payload
+                            explanation_slots[idx].markdown(f"**Summary & Interpretation:**\n{explanations[idx]}▌")
+                        else:
+                            remaining -= 1
+                            answered[idx] = True
+                            status[idx].empty()
+                            if preview_slots[idx] is not None:
+                                preview_slots[idx].empty()
+                            result = payload
+                            if result["answer_ready"]:
+                                # A short preview; the full ANSWER stays in the result cache
+                                try:
+                                    preview = chat_history.result_preview(result["answer"])
+                                except Exception:
+                                    # One odd result must not lose the other files' output
+                                    preview = chat_history.compact_text(repr(result["answer"]))
+                                file_messages[idx].append(("assistant", f"**Result:**\n{preview}", result["result_ref"]))
+                            if result["error"] is not None:
+                                with slots[idx]:
+                                    st.error(result["error"])
+                                    st.chat_message("assistant").markdown(result["error"])
+                                file_messages[idx].append(("assistant", result["error"]))
+                            else:
+                                explanation_slots[idx].markdown(f"**Summary & Interpretation:**\n{result['explanation']}")
+                                with slots[idx]:
+                                    st.caption(f"Explanation: {result['explanation_timing']}")
+                                file_messages[idx].append(("assistant", result["explanation"]))
+                except BaseException:
+                    # Streamlit stops a script by raising in it (StopException, RerunException)
+                    for job in jobs:
+                        job.cancel()
+                    raise
+            for messages in file_messages:
+                for message in messages:
+                    st.session_state.chat_history.append(*message)
+            st.session_state.perf_traces.record(trace)
         else:
             bot_response = "Please upload one or more CSV files first to analyze."
-            st.session_state.chat_history.append(("assistant", bot_response))
+            st.session_state.chat_history.append("assistant", bot_response)
             st.chat_message("assistant").markdown(bot_response)
     else:
         st.warning("Please configure the Gemini API Key in your Streamlit secrets to enable chat responses.")
@@ -9,11 +9,37 @@ Original file is located at
 
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
+import queue
 import traceback
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import chat_history
+import code_analysis
+import code_cache
+import context_builder
+import cubes
+import data_dictionary
+import dataset_registry
+import dataset_store
+import execution
+import export
+import ingestion
+import llm
+import model_backend
+import perf
+import prompt_builder
+import result_cache
+import result_digest
+import sampling
+import scheduler
+import sql_engine
+import worker_pool
+
+execution.enable_copy_on_write()
+
 # Set page configuration with dark theme
 st.set_page_config(
     page_title="AI Data Analyst",
@@ -190,9 +216,8 @@ st.markdown("""
 @st.cache_resource
 def setup_api():
     try:
-        key = st.secrets['gemini_api_key']
-        genai.configure(api_key=key)
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
+        # Gemini by default; CHAT_WITH_DATA_MODEL_BACKEND=stub replays recorded responses
+        model = model_backend.create_model(st.secrets)
         return model, True
     except Exception as e:
         st.error(f"Failed to configure Gemini API: {e}")
@@ -200,6 +225,49 @@ def setup_api():
 
 model, api_configured = setup_api()
 
+# Worker processes for generated code, shared by all sessions
+@st.cache_resource
+def get_worker_pool():
+    return worker_pool.WorkerPool()
+
+# Which sessions use which datasets, shared by all sessions
+@st.cache_resource
+def get_dataset_registry():
+    return dataset_registry.DatasetRegistry()
+
+
+# Reruns only the decorated function on its own widget events; older
+# Streamlit releases only have the experimental name, or no fragments at all
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+
+def select_file(idx):
+    st.session_state.current_file = idx
+
+
+# Requests shown in the sidebar Performance card
+PERF_CARD_REQUESTS = 5
+# How often the script thread checks for a sample preview during a full run
+PREVIEW_POLL_SECONDS = 0.1
+
+
+def bot_message_html(message):
+    return f"""
+                <div style="display: flex; justify-content: flex-start; margin-bottom: 10px; clear: both;">
+                    <div class="bot-message">
+                        <p style="margin: 0;">{message}</p>
+                    </div>
+                </div>
+                """
+
+
+def format_bytes(num_bytes):
+    if num_bytes > 1024**3:
+        return f"{num_bytes / 1024**3:.2f} GB"
+    if num_bytes > 1024**2:
+        return f"{num_bytes / 1024**2:.2f} MB"
+    return f"{num_bytes / 1024:.2f} KB"
+
 # Custom title with AI feel
 st.markdown("""
 <div class="title-container">
@@ -210,17 +278,25 @@ st.markdown("""
 
 # Initialize session state
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    st.session_state.chat_history = chat_history.ChatHistory()
 if "uploaded_data" not in st.session_state:
     st.session_state.uploaded_data = []
 if "data_context" not in st.session_state:
-    st.session_state.data_context = ""
+    st.session_state.data_context = context_builder.DataContext()
 if "data_dictionary" not in st.session_state:
     st.session_state.data_dictionary = None
-if "processing" not in st.session_state:
-    st.session_state.processing = False
+if "dictionary_index" not in st.session_state:
+    st.session_state.dictionary_index = None
+if "perf_traces" not in st.session_state:
+    st.session_state.perf_traces = perf.TraceBuffer()
+if "request_state" not in st.session_state:
+    st.session_state.request_state = "idle"
+if "pending_question" not in st.session_state:
+    st.session_state.pending_question = None
 if "current_file" not in st.session_state:
     st.session_state.current_file = None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Create sidebar for data upload and settings
 with st.sidebar:
@@ -251,6 +327,26 @@ with st.sidebar:
 
     st.markdown("</div>", unsafe_allow_html=True)
 
+    # Query engine card: pandas per file, or one DuckDB SQL query over all files
+    st.markdown("<div class='card'>", unsafe_allow_html=True)
+    st.markdown("<h4 style='color: #00CCFF;'>Query Engine</h4>", unsafe_allow_html=True)
+    st.checkbox(
+        "SQL engine mode (DuckDB)",
+        key="sql_mode",
+        disabled=not sql_engine.available(),
+        help="Answer with one SQL query across all uploaded files, so questions can join them. "
+             "Tables are named after the files. Requires the duckdb package."
+    )
+    st.checkbox(
+        "Progressive mode",
+        value=True,
+        key="progressive_mode",
+        help="On files of at least "
+             f"{sampling.PROGRESSIVE_MIN_ROWS:,} rows, show an approximate result from a sample first; "
+             "the result on all rows replaces it when ready."
+    )
+    st.markdown("</div>", unsafe_allow_html=True)
+
     # Display file status
     if st.session_state.uploaded_data:
         st.markdown("<div class='card'>", unsafe_allow_html=True)
@@ -259,12 +355,39 @@ with st.sidebar:
         for idx, (file_name, _) in enumerate(st.session_state.uploaded_data):
             is_active = st.session_state.current_file == idx
             file_status = "✓ " if is_active else ""
-            if st.button(f"{file_status}{file_name}", key=f"file_{idx}"):
-                st.session_state.current_file = idx
-                st.experimental_rerun()
+            st.button(f"{file_status}{file_name}", key=f"file_{idx}", on_click=select_file, args=(idx,))
 
         st.markdown("</div>", unsafe_allow_html=True)
 
+    # Performance card: stage breakdown of this session's last requests
+    st.markdown("<div class='card'>", unsafe_allow_html=True)
+    st.markdown("<h4 style='color: #00CCFF;'>Performance</h4>", unsafe_allow_html=True)
+    recent_traces = st.session_state.perf_traces.recent(PERF_CARD_REQUESTS)
+    if recent_traces:
+        perf_rows = []
+        for trace in recent_traces:
+            stage_totals = trace.stage_totals()
+            row = {"request": trace.label[:40], "total (s)": round(trace.wall_seconds, 2),
+                   "cpu (s)": round(trace.cpu_seconds, 2)}
+            for stage in perf.STAGES:
+                if stage in stage_totals:
+                    row[stage] = round(stage_totals[stage]["wall_seconds"], 2)
+            perf_rows.append(row)
+        st.dataframe(pd.DataFrame(perf_rows).set_index("request"), use_container_width=True)
+        last_totals = recent_traces[0].stage_totals()
+        st.markdown(
+            "<p style='color: #888; font-size: 0.8rem;'>Last request, CPU / peak memory growth: "
+            + ", ".join(
+                f"{stage} {last_totals[stage]['cpu_seconds']:.2f}s / {format_bytes(last_totals[stage]['peak_delta_bytes'])}"
+                for stage in perf.STAGES if stage in last_totals
+            )
+            + "</p>",
+            unsafe_allow_html=True
+        )
+    else:
+        st.markdown("<p style='color: #888; font-size: 0.8rem;'>No requests timed yet</p>", unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
     # About section
     st.markdown("<div class='card'>", unsafe_allow_html=True)
     st.markdown("<h4 style='color: #00CCFF;'>About</h4>", unsafe_allow_html=True)
@@ -274,63 +397,119 @@ with st.sidebar:
     """)
     current_time = datetime.now().strftime("%H:%M:%S")
     st.markdown(f"<p style='color: #888; font-size: 0.8rem;'>Current time: {current_time}</p>", unsafe_allow_html=True)
+    cache_stats = ingestion.cache_stats()
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>Ingestion cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses</p>",
+        unsafe_allow_html=True
+    )
+    code_stats = code_cache.default_cache().stats()
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>Code cache: {code_stats['hits']} hits / {code_stats['misses']} misses "
+        f"({code_stats['hit_rate']:.0%} hit rate, {code_stats['entries']} stored)</p>",
+        unsafe_allow_html=True
+    )
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>Code analysis: {code_analysis.stats_summary()}</p>",
+        unsafe_allow_html=True
+    )
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>Model requests: {scheduler.default_scheduler().summary()}</p>",
+        unsafe_allow_html=True
+    )
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>Aggregate cubes: {cubes.summary()}</p>",
+        unsafe_allow_html=True
+    )
     st.markdown("</div>", unsafe_allow_html=True)
 
-# Main content area
-col1, col2 = st.columns([2, 1])
+# Main content area: uploads and preview; the conversation lays out its own columns
+col1 = st.container()
 
 # Process uploaded files
+uploaded_hashes = set()
 if uploaded_files:
-    all_contexts = []
     new_files = []
 
     for file in uploaded_files:
-        # Check if file is already loaded
-        if not any(file.name == f[0] for f in st.session_state.uploaded_data):
-            try:
-                df = pd.read_csv(file)
-                new_files.append((file.name, df))
-
-                # Create data context for AI
-                description = df.describe(include='all').to_string()
-                sample_rows = df.head(3).to_string(index=False)
-                columns_info = "\n".join([f"- {col}: {dtype}" for col, dtype in zip(df.columns, df.dtypes)])
-                file_context = (
-                    f"File: {file.name}\n"
-                    f"Columns and Types:\n{columns_info}\n\n"
-                    f"Descriptive Statistics:\n{description}\n\n"
-                    f"Sample Records:\n{sample_rows}\n"
-                )
-                all_contexts.append(file_context)
-
-                with col1:
-                    st.markdown(f"""
-                    <div class='success-message'>
-                        ✅ File '{file.name}' successfully loaded
-                    </div>
-                    """, unsafe_allow_html=True)
+        try:
+            # Parsed frame and AI context come from the shared ingestion cache;
+            # large files are read in compact chunks with progress in the sidebar
+            progress_slot = st.sidebar.empty()
+            upload_trace = perf.RequestTrace(f"upload {file.name}", kind="upload")
+            ingested = ingestion.load_csv(
+                file,
+                progress=lambda fraction: progress_slot.progress(fraction, text=f"Reading {file.name}..."),
+                trace=upload_trace,
+            )
+            progress_slot.empty()
+            uploaded_hashes.add(ingested.content_hash)
+            # Already loaded: identical contents are recognized under any file name
+            known_hashes = {handle.content_hash for _, handle in st.session_state.uploaded_data + new_files}
+            if ingested.content_hash in known_hashes:
+                continue
+            ingestion.get_profile(ingested.handle, upload_trace)
+            # Large files get a sample once, reused by every question in progressive mode
+            sampling.ensure_sample(ingested.handle, upload_trace)
+            # Cubes for group-by questions are built on a background thread
+            cubes.schedule_build(ingested.handle)
+            st.session_state.perf_traces.record(upload_trace)
+            # Sessions keep only the store handle; data is memory-mapped on use
+            new_files.append((file.name, ingested.handle))
+
+            with col1:
+                st.markdown(f"""
+                <div class='success-message'>
+                    ✅ File '{file.name}' successfully loaded
+                </div>
+                """, unsafe_allow_html=True)
+                if ingested.report is not None:
+                    st.caption(f"Compact ingestion: {ingested.report.summary()}")
 
-            except Exception as e:
-                with col1:
-                    st.error(f"Error loading '{file.name}': {e}")
+        except Exception as e:
+            with col1:
+                st.error(f"Error loading '{file.name}': {e}")
 
     # Update session state with new files
     if new_files:
         st.session_state.uploaded_data.extend(new_files)
-        if st.session_state.current_file is None and st.session_state.uploaded_data:
-            st.session_state.current_file = 0
 
-        # Update data context
-        existing_context = st.session_state.data_context if st.session_state.data_context else "You are a helpful data analyst AI. The user uploaded multiple datasets. Here is the context for each:\n\n"
-        st.session_state.data_context = existing_context + "\n\n".join(all_contexts)
+# Files removed from the uploader leave the session too
+kept_files = [entry for entry in st.session_state.uploaded_data if entry[1].content_hash in uploaded_hashes]
+if len(kept_files) != len(st.session_state.uploaded_data):
+    st.session_state.uploaded_data = kept_files
+    st.session_state.current_file = None
+if st.session_state.current_file is None and st.session_state.uploaded_data:
+    st.session_state.current_file = 0
+# Only segments of added files are built; removed files drop theirs
+st.session_state.data_context.sync_datasets(st.session_state.uploaded_data)
+
+# Renew this session's leases; identical uploads of all sessions share one dataset
+registry = get_dataset_registry()
+registry.sync(st.session_state.session_id, st.session_state.uploaded_data)
+
+with st.sidebar:
+    # Server Memory card: every dataset resident in this server process
+    st.markdown("<div class='card'>", unsafe_allow_html=True)
+    st.markdown("<h4 style='color: #00CCFF;'>Server Memory</h4>", unsafe_allow_html=True)
+    registry_rows = registry.snapshot()
+    if registry_rows:
+        st.dataframe(pd.DataFrame(registry_rows).set_index("dataset"), use_container_width=True)
+    st.markdown(
+        f"<p style='color: #888; font-size: 0.8rem;'>{registry.summary()}</p>",
+        unsafe_allow_html=True
+    )
+    st.markdown("</div>", unsafe_allow_html=True)
 
 # Process data dictionary
 if dict_file is not None:
     try:
-        data_dict = pd.read_csv(dict_file)
+        ingested_dict = ingestion.load_csv(dict_file)
+        data_dict = ingested_dict.df
         st.session_state.data_dictionary = data_dict
-        dict_info = data_dict.to_string(index=False)
-        st.session_state.data_context += f"\n\nData Dictionary:\n{dict_info}"
+        # Parsed and indexed once per dictionary; questions are looked up against it
+        st.session_state.dictionary_index = data_dictionary.load(ingested_dict.content_hash, data_dict)
+        # Replaces the previous dictionary segment instead of appending on every rerun
+        st.session_state.data_context.set_dictionary(ingested_dict.content_hash, data_dict)
 
         with col1:
             st.markdown("""
@@ -341,11 +520,16 @@ if dict_file is not None:
     except Exception as e:
         with col1:
             st.error(f"Error loading data dictionary: {e}")
+else:
+    st.session_state.data_context.clear_dictionary()
 
 # Display current dataset preview
 with col1:
     if st.session_state.uploaded_data and st.session_state.current_file is not None:
-        current_filename, current_df = st.session_state.uploaded_data[st.session_state.current_file]
+        current_filename, current_handle = st.session_state.uploaded_data[st.session_state.current_file]
+        # Metrics come from the cached profile instead of rescanning the frame
+        current_profile = ingestion.get_profile(current_handle)
+        current_df = dataset_store.open_dataframe(current_handle)
 
         st.markdown(f"""
         <div class='card'>
@@ -357,19 +541,17 @@ with col1:
         st.markdown("<div class='card'>", unsafe_allow_html=True)
         col_stats1, col_stats2, col_stats3 = st.columns(3)
         with col_stats1:
-            st.metric("Rows", f"{current_df.shape[0]:,}")
+            st.metric("Rows", f"{current_profile.rows:,}")
         with col_stats2:
-            st.metric("Columns", current_df.shape[1])
+            st.metric("Columns", current_profile.num_columns)
         with col_stats3:
-            memory_usage = current_df.memory_usage(deep=True).sum()
-            memory_unit = "KB"
-            if memory_usage > 1024**2:
-                memory_usage = memory_usage / (1024**2)
-                memory_unit = "MB"
-            elif memory_usage > 1024:
-                memory_usage = memory_usage / 1024
-                memory_unit = "KB"
-            st.metric("Memory Usage", f"{memory_usage:.2f} {memory_unit}")
+            # Mapped bytes live in the page cache; resident bytes are heap copies
+            st.metric(
+                "Memory Usage",
+                f"{format_bytes(current_profile.resident_bytes)} resident",
+                f"{format_bytes(current_profile.mapped_bytes)} mapped",
+                delta_color="off"
+            )
         st.markdown("</div>", unsafe_allow_html=True)
 
         # Data preview
@@ -385,174 +567,386 @@ with col1:
             st.dataframe(st.session_state.data_dictionary, use_container_width=True)
             st.markdown("</div>", unsafe_allow_html=True)
 
-# Chat interface
-with col1:
-    st.markdown("<div class='card'>", unsafe_allow_html=True)
-    st.markdown("<h3 style='color: #00CCFF;'>💬 AI Data Assistant</h3>", unsafe_allow_html=True)
-
-    # Display welcome message if chat history is empty
-    if not st.session_state.chat_history:
-        st.markdown("""
-        <div style="padding: 15px; border-radius: 10px; background-color: #252a33; margin-bottom: 20px;">
-            <p style="margin: 0; color: #00CCFF;"><strong>👋 Welcome to AI Data Analyst!</strong></p>
-            <p>Upload your CSV files and ask me questions about your data. I can help with:</p>
-            <ul>
-                <li>Data analysis and statistics</li>
-                <li>Visualizations and trends</li>
-                <li>Finding insights in your data</li>
-                <li>Answering specific questions about your dataset</li>
-            </ul>
-            <p style="margin: 0; font-style: italic; color: #888;">Example: "What's the average age in the dataset?" or "Show me the distribution of sales by region"</p>
+# Chat interface. A question is a small state machine kept in session state:
+# "idle" -> "pending" (set by the input's on_change callback, before the run)
+# -> "running" -> "idle". The chat and result regions are a fragment, so a
+# question runs in them only, followed by one full rerun for the sidebar stats,
+# instead of the whole script three times.
+def submit_question():
+    question = st.session_state.chat_input.strip()
+    st.session_state.chat_input = ""
+    if not question or st.session_state.request_state != "idle":
+        return
+    st.session_state.chat_history.append("user", question)
+    st.session_state.pending_question = question
+    st.session_state.request_state = "pending"
+
+
+def render_download(entry):
+    """The full result as a file; it is written in chunks on disk, never built as one string."""
+    fmt = st.selectbox("Format", list(export.FORMATS), key=f"export_format_{entry.seq}")
+    key = export.export_key(entry.result.code, entry.result.dataset_hash, fmt)
+    prepared = export.get(key)
+    if prepared is None:
+        answer = entry.result.load()
+        if answer is result_cache.MISSING:
+            st.caption("The full result is no longer cached; ask the question again to recompute it.")
+            return
+        try:
+            with st.spinner(f"Writing {fmt} file..."):
+                prepared = export.prepare(answer, fmt, key)
+        except export.ExportError as e:
+            st.error(str(e))
+            return
+    st.caption(f"Export: {prepared.summary()}")
+    url = export.static_url(prepared) if st.get_option("server.enableStaticServing") else None
+    if url is not None:
+        # Streamed from disk by Streamlit's static file server
+        st.markdown(
+            f'<a href="{url}" download="{prepared.file_name}">Download {prepared.file_name}</a>',
+            unsafe_allow_html=True,
+        )
+    elif prepared.size_bytes <= export.MAX_INLINE_BYTES:
+        # download_button keeps the whole file in server memory
+        with open(prepared.path, "rb") as f:
+            st.download_button(
+                f"Download {prepared.file_name}", data=f, file_name=prepared.file_name, mime=prepared.mime,
+                key=f"export_download_{entry.seq}",
+            )
+    else:
+        st.warning(
+            f"Files over {export.MAX_INLINE_BYTES / 1024**2:,.0f} MB can only be downloaded with static file "
+            "serving enabled (server.enableStaticServing in .streamlit/config.toml)."
+        )
+
+
+def render_entry(entry):
+    if entry.role == "user":
+        st.markdown(f"""
+        <div style="display: flex; justify-content: flex-end; margin-bottom: 10px; clear: both;">
+            <div class="user-message">
+                <p style="margin: 0;">{entry.text}</p>
+            </div>
         </div>
         """, unsafe_allow_html=True)
+    else:
+        st.markdown(bot_message_html(entry.text), unsafe_allow_html=True)
+    # The full value of a result is loaded from the result cache only on request
+    if entry.result is not None and st.checkbox("Show full result", key=f"full_result_{entry.seq}"):
+        answer = entry.result.load()
+        if answer is result_cache.MISSING:
+            st.caption("The full result is no longer cached; ask the question again to recompute it.")
+        elif isinstance(answer, pd.DataFrame):
+            st.dataframe(answer, use_container_width=True)
+        else:
+            st.write(answer)
+    if entry.result is not None and st.checkbox("Download full result", key=f"download_result_{entry.seq}"):
+        render_download(entry)
+
+
+def render_chat_history():
+    """The latest messages; earlier ones a page at a time, so each run renders a bounded amount."""
+    history = st.session_state.chat_history
+    older_pages = history.older_pages()
+    if older_pages and st.checkbox(
+        f"Show earlier messages ({len(history) - chat_history.RECENT_MESSAGES} more)", key="show_older_messages"
+    ):
+        page = st.number_input(
+            "Page (1 = oldest)", min_value=1, max_value=older_pages, value=older_pages, key="history_page"
+        )
+        for entry in history.older_page(page - 1):
+            render_entry(entry)
+    for entry in history.recent():
+        render_entry(entry)
+
+
+def show_preview(slot, answer, stats, label):
+    """An approximate ANSWER from the sample, shown until the full run finishes."""
+    with slot.container():
+        st.markdown("<div class='card'>", unsafe_allow_html=True)
+        st.markdown("<h3 style='color: #00CCFF;'>🔍 Preview Result</h3>", unsafe_allow_html=True)
+        st.info(label)
+        if isinstance(answer, pd.DataFrame):
+            st.dataframe(answer.head(10), use_container_width=True)
+        else:
+            st.markdown(f"```\n{result_digest.digest(answer, result_digest.PREVIEW_TOKENS)}\n```")
+        st.caption(f"Sample execution: {stats.summary()}")
+        st.markdown("</div>", unsafe_allow_html=True)
 
-    # Chat message container
-    chat_container = st.container()
+
+def show_answer(question, answer_result, result_ref, exec_stats, label, chat_container, result_col, trace, sql=None):
+    """Render an ANSWER in the result card, then stream its explanation into the chat."""
+    # Add a bounded digest to chat history; the full ANSWER stays in the result cache
+    result_message = f"**Analysis Result:**\n{chat_history.result_preview(answer_result)}"
+    st.session_state.chat_history.append("assistant", result_message, result_ref)
     with chat_container:
-        for i, (role, message) in enumerate(st.session_state.chat_history):
-            if role == "user":
-                st.markdown(f"""
-                <div style="display: flex; justify-content: flex-end; margin-bottom: 10px; clear: both;">
-                    <div class="user-message">
-                        <p style="margin: 0;">{message}</p>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div style="display: flex; justify-content: flex-start; margin-bottom: 10px; clear: both;">
-                    <div class="bot-message">
-                        <p style="margin: 0;">{message}</p>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+        st.markdown(bot_message_html(result_message), unsafe_allow_html=True)
 
-    # Processing indicator
-    if st.session_state.processing:
-        st.markdown("""
-        <div class="ai-processing">
-            <p>AI is analyzing your data...</p>
-            <div class="loading-bar"></div>
-        </div>
-        """, unsafe_allow_html=True)
+    # Prompt for explanation, with a bounded digest of the result instead of str(ANSWER)
+    explain_prompt = f'''
+The user asked: "{question}"
+Here is the result:\n{result_digest.digest(answer_result)}
+Answer the question and summarize the findings in a clear, concise way.
+Include your opinion of the persona of this customer if relevant.
+Format your response with markdown for readability.
+'''
+    # Display analysis result in the right column; only its first rows are kept
+    # for redrawing it on later reruns
+    if isinstance(answer_result, pd.DataFrame):
+        shown = answer_result.head(10)
+    else:
+        shown = chat_history.compact_text(answer_result)
+    st.session_state.result_card = {
+        "shown": shown,
+        "rows": len(answer_result) if isinstance(answer_result, pd.DataFrame) else None,
+        "exec_summary": exec_stats.summary() if exec_stats is not None else None,
+        "sql": sql,
+    }
+    with trace.span("render", label):
+        render_result_card(result_col, st.session_state.result_card)
 
-    # Input form
-    user_input = st.text_input(
-        "พิมพ์คำถามที่ต้องการได้เลยครับ",
-        key="chat_input",
-        disabled=not api_configured or not st.session_state.uploaded_data,
-        placeholder="Ask about your data..."
-    )
+    # Stream the explanation into a chat bubble as it arrives
+    with chat_container:
+        explanation_slot = st.empty()
+    stream = llm.TextStream(model, explain_prompt)
+    with trace.span("explain", label):
+        for _ in stream:
+            explanation_slot.markdown(bot_message_html(stream.text + "▌"), unsafe_allow_html=True)
+    explanation_text = stream.text
+    explanation_slot.markdown(bot_message_html(explanation_text), unsafe_allow_html=True)
+    st.session_state.chat_history.append("assistant", explanation_text)
+    st.session_state.explanation_timing = stream.timing_summary()
+
+
+def render_result_card(result_col, card):
+    with result_col:
+        st.markdown("<div class='card'>", unsafe_allow_html=True)
+        st.markdown("<h3 style='color: #00CCFF;'>🔍 Analysis Result</h3>", unsafe_allow_html=True)
 
-    if not api_configured:
-        st.warning("⚠️ Please configure the Gemini API Key in your Streamlit secrets to enable chat responses.")
-    elif not st.session_state.uploaded_data:
-        st.info("📤 Please upload data files to begin analysis")
+        if isinstance(card["shown"], pd.DataFrame):
+            st.dataframe(card["shown"], use_container_width=True)
+
+            if card["rows"] > 10:
+                st.info(f"Showing 10 of {card['rows']} total rows")
+
+        else:
+            st.markdown(f"```\n{card['shown']}\n```")
+
+        if card["exec_summary"] is not None:
+            st.caption(f"Execution: {card['exec_summary']}")
+        if card["sql"] is not None:
+            with st.expander("SQL query"):
+                st.code(card["sql"], language="sql")
+
+        st.markdown("</div>", unsafe_allow_html=True)
 
-    st.markdown("</div>", unsafe_allow_html=True)
 
-# Handle user input & AI response
-if user_input:
-    # Add user message to chat history
-    st.session_state.chat_history.append(("user", user_input))
-    st.session_state.processing = True
-    st.experimental_rerun()
+def show_error(e, chat_container):
+    error_msg = f"⚠️ An error occurred: {str(e)}"
+    st.session_state.chat_history.append("assistant", error_msg)
+    with chat_container:
+        st.markdown(bot_message_html(error_msg), unsafe_allow_html=True)
+
 
-# Process the response (This will run after the rerun if there's pending input)
-if st.session_state.processing and st.session_state.uploaded_data:
-    for file_index, (file_name, df) in enumerate(st.session_state.uploaded_data):
+def answer_question(question, chat_container, result_col):
+    """Run the pipeline for one question, rendering into the given regions."""
+    dictionary = st.session_state.dictionary_index
+    trace = perf.RequestTrace(question)
+    # SQL engine mode: one DuckDB query over every uploaded file instead of a loop over files
+    if st.session_state.get("sql_mode") and sql_engine.available():
+        try:
+            sql_answer = sql_engine.answer_question(question, st.session_state.uploaded_data, model, dictionary, trace)
+            result_ref = chat_history.ResultRef(sql_answer.sql, sql_answer.dataset_hash)
+            show_answer(question, sql_answer.answer, result_ref, sql_answer.stats, "sql",
+                        chat_container, result_col, trace, sql=sql_answer.sql)
+        except Exception as e:
+            show_error(e, chat_container)
+        st.session_state.perf_traces.record(trace)
+        return
+
+    for file_index, (file_name, handle) in enumerate(st.session_state.uploaded_data):
         if st.session_state.current_file is not None and file_index != st.session_state.current_file:
             continue
 
+        df = dataset_store.open_dataframe(handle)
+
         df_name = "df"
-        example_record = df.head(2).to_string(index=False)
         data_dict_text = "\n".join([f"{col}: {dtype}" for col, dtype in zip(df.columns, df.dtypes)])
-        question = st.session_state.chat_history[-1][1]  # Get the last user question
-
-        # Prompt for code generation
-        code_prompt = f"""
-You are a helpful Python code generator.
-Your goal is to write Python code snippets based on the user's question and the provided DataFrame information.
-Here's the context:
-**User Question:**
-{question}
-**DataFrame Name:**
-{df_name}
-**DataFrame Details:**
-{data_dict_text}
-**Sample Data (Top 2 Rows):**
-{example_record}
-
-**Instructions:**
-1. Write Python code that addresses the user's question by querying or manipulating the DataFrame.
-2. **Use the `exec()` function to execute the generated code.**
-3. Do not import pandas, but you may assume `pd` (pandas) is already available.
-4. Change date column type to datetime if needed.
-5. Store the result in a variable named `ANSWER`.
-6. Assume the DataFrame is already loaded into a pandas DataFrame object named `{df_name}`.
-7. Keep the generated code concise and focused on answering the question.
-8. If the question requires a specific output format (e.g., a list, a single value), ensure the `ANSWER` variable holds that format.
-"""
 
-        try:
-            response = model.generate_content(code_prompt)
-            generated_code = response.text
+        # Prompt for code generation: only the columns relevant to the question,
+        # within the token budget, ranked from the cached profile and dictionary
+        profile = ingestion.get_profile(handle, trace)
+        with trace.span("prompt", file_name):
+            columns_index = prompt_builder.column_index(handle.content_hash, profile)
+            code_prompt = prompt_builder.build_code_prompt(
+                question, columns_index, df_name, include_example=False, dictionary=dictionary
+            ).text
 
-            # Clean the code and execute it
-            cleaned_code = generated_code.strip().replace("```python", "").replace("```", "")
-            local_vars = {df_name: df.copy(), "pd": pd}
-            exec(cleaned_code, {}, local_vars)
+        try:
+            # Reuse code that already answered this question on the same schema
+            schema_fingerprint = code_cache.schema_fingerprint(data_dict_text)
+            cleaned_code = code_cache.default_cache().get(question, schema_fingerprint)
+            code_from_cache = cleaned_code is not None
+            if not code_from_cache:
+                with trace.span("generate", file_name):
+                    generated_code = llm.generate_text(model, code_prompt)
+                    # Vectorize slow row-wise patterns, or regenerate once without them
+                    analysis = code_analysis.gate(
+                        code_analysis.clean_generated_code(generated_code),
+                        regenerate=lambda feedback: llm.generate_text(model, code_prompt + feedback),
+                    )
+                cleaned_code = analysis.code
+            # Identical code on identical data returns the memoized ANSWER
+            cached_answer = result_cache.default_cache().get(cleaned_code, handle.content_hash)
+            if cached_answer is not result_cache.MISSING:
+                local_vars = {"ANSWER": cached_answer}
+                exec_stats = None
+            else:
+                # Group-by aggregates over low-cardinality columns come from the cubes
+                # built after upload, without scanning the dataset
+                cube_hit = cubes.answer(cleaned_code, handle, df_name)
+                if cube_hit is not None:
+                    local_vars, exec_stats = {"ANSWER": cube_hit.answer}, cube_hit
+                else:
+                    # Progressive mode: a quick approximate ANSWER from the sample first
+                    # in a thread of its own, while the full run starts right away
+                    preview_slot = None
+                    previews = queue.Queue()
+                    progressive = st.session_state.get("progressive_mode", True)
+                    sample = sampling.get_sample(handle) if progressive else None
+                    preview_job = None
+                    if sample is not None:
+                        preview_job = sampling.start_preview(
+                            get_worker_pool(), cleaned_code, sample, lambda *preview: previews.put(preview),
+                            df_name, trace, f"{file_name} (sample)",
+                        )
+                    # Runs in a prewarmed worker process with a timeout and memory cap;
+                    # the code gets a copy-on-write view, not a deep copy of the dataset
+                    full_job = worker_pool.Job()
+                    try:
+                        with trace.span("exec", file_name), ThreadPoolExecutor(max_workers=1) as executor:
+                            full_run = executor.submit(get_worker_pool().run, cleaned_code, handle, df_name, job=full_job)
+                            try:
+                                # Streamlit calls stay on the script thread: wait here for
+                                # whichever comes first, the preview or the full result
+                                while sample is not None and preview_slot is None and not full_run.done():
+                                    try:
+                                        preview = previews.get(timeout=PREVIEW_POLL_SECONDS)
+                                    except queue.Empty:
+                                        continue
+                                    if not full_run.done():
+                                        preview_slot = result_col.empty()
+                                        show_preview(preview_slot, preview[0], preview[1], sample.label())
+                                local_vars, exec_stats = full_run.result()
+                            except BaseException:
+                                # A stopped or rerun script (StopException, RerunException) must
+                                # not leave its worker running until the timeout
+                                full_job.cancel()
+                                raise
+                    finally:
+                        # A sample run still going would hold a worker for nothing
+                        if preview_job is not None:
+                            preview_job.cancel()
+                        if preview_slot is not None:
+                            preview_slot.empty()
+                if "ANSWER" in local_vars:
+                    result_cache.default_cache().put(cleaned_code, handle.content_hash, local_vars["ANSWER"])
+            if not code_from_cache and "ANSWER" in local_vars:
+                code_cache.default_cache().put(question, schema_fingerprint, cleaned_code)
 
             # Check if ANSWER variable exists in the local variables
             if "ANSWER" not in local_vars:
                 answer_result = "No result in variable ANSWER"
+                result_ref = None
             else:
                 answer_result = local_vars["ANSWER"]
+                result_ref = chat_history.ResultRef(cleaned_code, handle.content_hash)
 
-            # Display result based on type
-            if isinstance(answer_result, pd.DataFrame):
-                result_preview = f"DataFrame with {len(answer_result)} rows and {len(answer_result.columns)} columns"
-            else:
-                result_preview = str(answer_result)
+            show_answer(question, answer_result, result_ref, exec_stats, file_name, chat_container, result_col, trace)
 
-            # Add result to chat history
-            st.session_state.chat_history.append(("assistant", f"**Analysis Result:**\n{result_preview}"))
+        except Exception as e:
+            show_error(e, chat_container)
 
-            # Prompt for explanation
-            explain_prompt = f'''
-The user asked: "{question}"
-Here is the result:\n{str(answer_result)}
-Answer the question and summarize the findings in a clear, concise way.
-Include your opinion of the persona of this customer if relevant.
-Format your response with markdown for readability.
-'''
-            explain_response = model.generate_content(explain_prompt)
-            explanation_text = explain_response.text
-            st.session_state.chat_history.append(("assistant", explanation_text))
+    st.session_state.perf_traces.record(trace)
 
-            # Display analysis result in the right column
-            with col2:
-                st.markdown("<div class='card'>", unsafe_allow_html=True)
-                st.markdown("<h3 style='color: #00CCFF;'>🔍 Analysis Result</h3>", unsafe_allow_html=True)
 
-                if isinstance(answer_result, pd.DataFrame):
-                    st.dataframe(answer_result.head(10), use_container_width=True)
+@fragment
+def conversation():
+    chat_col, result_col = st.columns([2, 1])
+    with chat_col:
+        st.markdown("<div class='card'>", unsafe_allow_html=True)
+        st.markdown("<h3 style='color: #00CCFF;'>💬 AI Data Assistant</h3>", unsafe_allow_html=True)
 
-                    if len(answer_result) > 10:
-                        st.info(f"Showing 10 of {len(answer_result)} total rows")
+        # A run stopped mid-question (e.g. by another widget) leaves "running" behind
+        if st.session_state.request_state == "running":
+            st.session_state.chat_history.append("assistant", "⚠️ The previous question was interrupted.")
+            st.session_state.request_state = "idle"
 
-                else:
-                    st.markdown(f"```\n{answer_result}\n```")
+        # Display welcome message if chat history is empty
+        if not st.session_state.chat_history:
+            st.markdown("""
+            <div style="padding: 15px; border-radius: 10px; background-color: #252a33; margin-bottom: 20px;">
+                <p style="margin: 0; color: #00CCFF;"><strong>👋 Welcome to AI Data Analyst!</strong></p>
+                <p>Upload your CSV files and ask me questions about your data. I can help with:</p>
+                <ul>
+                    <li>Data analysis and statistics</li>
+                    <li>Visualizations and trends</li>
+                    <li>Finding insights in your data</li>
+                    <li>Answering specific questions about your dataset</li>
+                </ul>
+                <p style="margin: 0; font-style: italic; color: #888;">Example: "What's the average age in the dataset?" or "Show me the distribution of sales by region"</p>
+            </div>
+            """, unsafe_allow_html=True)
 
-                st.markdown("</div>", unsafe_allow_html=True)
+        # Chat message container
+        chat_container = st.container()
+        with chat_container:
+            render_chat_history()
+
+        status_slot = st.empty()
+        timing_slot = st.empty()
+
+        if st.session_state.request_state == "pending" and st.session_state.uploaded_data:
+            st.session_state.request_state = "running"
+            # Processing indicator
+            status_slot.markdown("""
+            <div class="ai-processing">
+                <p>AI is analyzing your data...</p>
+                <div class="loading-bar"></div>
+            </div>
+            """, unsafe_allow_html=True)
+            answer_question(st.session_state.pending_question, chat_container, result_col)
+            status_slot.empty()
+            st.session_state.request_state = "idle"
+            # The sidebar Performance card and the cache, scheduler and cube stats are
+            # drawn outside this fragment; one full rerun brings them up to date
+            st.rerun()
+        st.session_state.request_state = "idle"
+        # The last answer's card survives the rerun above and later ones
+        if st.session_state.get("result_card") is not None:
+            render_result_card(result_col, st.session_state.result_card)
+
+        if st.session_state.get("explanation_timing"):
+            timing_slot.caption(f"Last explanation: {st.session_state.explanation_timing}")
+
+        # Input form; submitting runs `submit_question` before this fragment reruns
+        st.text_input(
+            "พิมพ์คำถามที่ต้องการได้เลยครับ",
+            key="chat_input",
+            on_change=submit_question,
+            disabled=not api_configured or not st.session_state.uploaded_data,
+            placeholder="Ask about your data..."
+        )
+
+        if not api_configured:
+            st.warning("⚠️ Please configure the Gemini API Key in your Streamlit secrets to enable chat responses.")
+        elif not st.session_state.uploaded_data:
+            st.info("📤 Please upload data files to begin analysis")
+
+        st.markdown("</div>", unsafe_allow_html=True)
 
-        except Exception as e:
-            error_msg = f"⚠️ An error occurred: {str(e)}"
-            st.session_state.chat_history.append(("assistant", error_msg))
 
-    # Reset processing flag
-    st.session_state.processing = False
-    st.experimental_rerun()
+conversation()
 
 # Add a footer
 st.markdown("""
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""Static checks for slow patterns in generated pandas code.
+
+Generated code used to go straight from the model to `exec`. The model
+sometimes loops over rows (`iterrows`, `itertuples`, `range(len(df))`),
+applies Python functions row by row with `apply(axis=1)` or converts the
+same column with `pd.to_datetime` several times, all of which run orders of
+magnitude slower than vectorized pandas on our data.
+
+`gate` parses the code and looks for these patterns. Two of them are
+rewritten in place when it is provably safe:
+
+- `df.apply(lambda r: <arithmetic on r['col']>, axis=1)` becomes the same
+  arithmetic on `df['col']`;
+- repeated identical `pd.to_datetime(...)` calls on unmodified data are
+  computed once, before the first top-level statement that always runs
+  them; calls under an `if` or loop are never moved out of it.
+
+Anything left over is described to the model, which gets one chance to
+regenerate the code. Compiled code objects are cached by code hash, and
+per-pattern counts are kept for the UI.
+"""
+
+import ast
+import hashlib
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+
+from caching import LRUCache
+
+MAX_COMPILED = 256
+
+PATTERNS = {
+    "iterrows": "iterates over rows with iterrows() or itertuples()",
+    "apply_axis1": "applies a Python function row by row with apply(axis=1)",
+    "row_loop": "loops over row positions with range(len(...))",
+    "repeated_to_datetime": "converts the same data with pd.to_datetime more than once",
+}
+
+_VECTOR_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_VECTOR_UNARYOPS = (ast.USub, ast.UAdd)
+_VECTOR_COMPARE = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+HOISTED_PREFIX = "_to_datetime_"
+# Methods that modify their object without an inplace keyword
+_MUTATING_METHODS = {
+    "pop", "update", "insert", "append", "extend", "remove", "clear", "setdefault", "popitem",
+    "__setitem__", "__delitem__",
+}
+
+_compiled = LRUCache(max_entries=MAX_COMPILED)
+_stats_lock = threading.Lock()
+_flagged = Counter()
+_rewritten = Counter()
+_regenerations = 0
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Analysis:
+    code: str
+    # Patterns still present after rewriting: {pattern: occurrences}
+    issues: dict = field(default_factory=dict)
+    rewrites: dict = field(default_factory=dict)
+    regenerated: bool = False
+
+    def feedback(self):
+        """Prompt addendum asking the model to fix the remaining issues."""
+        problems = "; ".join(PATTERNS[pattern] for pattern in self.issues)
+        return (
+            "\n\n**Performance requirement:**\n"
+            f"Your previous code was rejected because it {problems}. "
+            "Rewrite it with vectorized pandas operations (column arithmetic, boolean masks, "
+            "groupby, merge, .dt and .str accessors) and no Python loops over rows.\n"
+            f"Previous code:\n```python\n{self.code}\n```\n"
+        )
+
+
+def clean_generated_code(text):
+    """Strip the Markdown fences the model wraps code in."""
+    return text.strip().replace("```python", "").replace("```", "")
+
+
+def _is_to_datetime(node):
+    func = node.func
+    return isinstance(func, ast.Attribute) and func.attr == "to_datetime" and isinstance(func.value, ast.Name) \
+        and func.value.id in ("pd", "pandas")
+
+
+def _is_row_apply(node):
+    if not (isinstance(node.func, ast.Attribute) and node.func.attr == "apply"):
+        return False
+    for keyword in node.keywords:
+        if keyword.arg == "axis" and isinstance(keyword.value, ast.Constant) and keyword.value.value in (1, "columns"):
+            return True
+    return False
+
+
+def _find(tree):
+    """Occurrences of each pattern in a parsed module."""
+    found = Counter()
+    to_datetime = Counter()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute) and node.func.attr in ("iterrows", "itertuples"):
+                found["iterrows"] += 1
+            elif _is_row_apply(node):
+                found["apply_axis1"] += 1
+            elif _is_to_datetime(node):
+                to_datetime[ast.dump(node)] += 1
+        elif isinstance(node, (ast.For, ast.comprehension)):
+            iterator = node.iter
+            if isinstance(iterator, ast.Call) and isinstance(iterator.func, ast.Name) and iterator.func.id == "range" \
+                    and any(isinstance(arg, ast.Call) and isinstance(arg.func, ast.Name) and arg.func.id == "len"
+                            for arg in iterator.args):
+                found["row_loop"] += 1
+    repeated = sum(count for count in to_datetime.values() if count > 1)
+    if repeated:
+        found["repeated_to_datetime"] = repeated
+    return found
+
+
+def _constant_key(subscript):
+    """'col' for `x['col']`, else None."""
+    key = subscript.slice
+    if isinstance(key, ast.Constant) and isinstance(key.value, str):
+        return key.value
+    return None
+
+
+def _column_key(node, row_name):
+    """'col' for `r['col']` on the lambda's row argument, else None."""
+    # `r.col` is left alone: it may be a Series attribute (r.name is the row label)
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == row_name:
+        return _constant_key(node)
+    return None
+
+
+def _vectorize(node, row_name, frame_name):
+    """`node` with row access replaced by column access, or None if not elementwise-safe."""
+    column = _column_key(node, row_name)
+    if column is not None:
+        return ast.Subscript(value=ast.Name(id=frame_name, ctx=ast.Load()), slice=ast.Constant(value=column),
+                             ctx=ast.Load())
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node
+    if isinstance(node, ast.BinOp) and isinstance(node.op, _VECTOR_BINOPS):
+        left = _vectorize(node.left, row_name, frame_name)
+        right = _vectorize(node.right, row_name, frame_name)
+        if left is None or right is None:
+            return None
+        return ast.BinOp(left=left, op=node.op, right=right)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, _VECTOR_UNARYOPS):
+        operand = _vectorize(node.operand, row_name, frame_name)
+        return None if operand is None else ast.UnaryOp(op=node.op, operand=operand)
+    # Chained comparisons (a < b < c) do not vectorize
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], _VECTOR_COMPARE):
+        left = _vectorize(node.left, row_name, frame_name)
+        right = _vectorize(node.comparators[0], row_name, frame_name)
+        if left is None or right is None:
+            return None
+        return ast.Compare(left=left, ops=node.ops, comparators=[right])
+    return None
+
+
+def _uses_row_column(node, row_name):
+    return any(_column_key(child, row_name) is not None for child in ast.walk(node))
+
+
+class _RowApplyRewriter(ast.NodeTransformer):
+    """df.apply(lambda r: r['a'] * r['b'], axis=1) -> (df['a'] * df['b'])."""
+
+    def __init__(self):
+        self.rewrites = 0
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not _is_row_apply(node) or len(node.args) != 1 or len(node.keywords) != 1:
+            return node
+        frame, function = node.func.value, node.args[0]
+        if not isinstance(frame, ast.Name) or not isinstance(function, ast.Lambda):
+            return node
+        arguments = function.args
+        if len(arguments.args) != 1 or arguments.vararg or arguments.kwarg or arguments.kwonlyargs:
+            return node
+        row_name = arguments.args[0].arg
+        # A body without any row column is not a row-wise computation we understand
+        if not _uses_row_column(function.body, row_name):
+            return node
+        vectorized = _vectorize(function.body, row_name, frame.id)
+        if vectorized is None:
+            return node
+        self.rewrites += 1
+        return vectorized
+
+
+def _bound_names(tree):
+    """Names that are assigned, loop or function variables, or modified in place."""
+    names = set()
+
+    def base_name(target):
+        # `df['col'] = ...` only changes that column of df
+        if isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name):
+            key = _constant_key(target)
+            if key is not None:
+                names.add((target.value.id, key))
+                return
+        while isinstance(target, (ast.Subscript, ast.Attribute, ast.Starred)):
+            target = target.value
+        if isinstance(target, ast.Name):
+            names.add(target.id)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                base_name(element)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                base_name(target)
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign, ast.For, ast.comprehension)):
+            base_name(node.target)
+        elif isinstance(node, ast.NamedExpr):
+            base_name(node.target)
+        elif isinstance(node, ast.withitem) and node.optional_vars is not None:
+            base_name(node.optional_vars)
+        elif isinstance(node, (ast.Lambda, ast.FunctionDef)):
+            for argument in node.args.args + node.args.kwonlyargs:
+                names.add(argument.arg)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr in _MUTATING_METHODS or any(keyword.arg == "inplace" for keyword in node.keywords):
+                base_name(node.func.value)
+        elif isinstance(node, ast.Delete):
+            for target in node.targets:
+                base_name(target)
+    return names
+
+
+# Top-level statements that evaluate all of their non-conditional parts
+_SIMPLE_STATEMENTS = (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Expr)
+_CONDITIONAL_EXPRESSIONS = (ast.IfExp, ast.BoolOp, ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp,
+                            ast.GeneratorExp)
+
+
+def _unconditional_to_datetime(statement):
+    """pd.to_datetime calls that run whenever the top-level `statement` runs."""
+    if not isinstance(statement, _SIMPLE_STATEMENTS):
+        return []
+    calls = []
+    stack = [statement]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, _CONDITIONAL_EXPRESSIONS):
+            continue
+        if isinstance(node, ast.Call) and _is_to_datetime(node):
+            calls.append(node)
+            continue
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+    return calls
+
+
+class _ReplaceCalls(ast.NodeTransformer):
+    def __init__(self, replacements):
+        self.replacements = replacements
+
+    def visit_Call(self, node):
+        name = self.replacements.get(ast.dump(node))
+        if name is not None:
+            return ast.Name(id=name, ctx=ast.Load())
+        self.generic_visit(node)
+        return node
+
+
+def _hoist_to_datetime(tree):
+    """Compute repeated identical pd.to_datetime calls once. Returns the number hoisted.
+
+    Only calls in top-level statements that always run are considered, so a
+    call guarded by an `if`, loop or conditional expression is never moved
+    out of its guard. The shared value is computed right before the first
+    such statement and replaces every identical call from there on.
+    """
+    occurrences = {}
+    for index, statement in enumerate(tree.body):
+        for node in _unconditional_to_datetime(statement):
+            occurrences.setdefault(ast.dump(node), []).append((index, node))
+    bound = _bound_names(tree)
+    names = {}
+    for key, found in occurrences.items():
+        if len(found) < 2:
+            continue
+        call = found[0][1]
+        used = {node.id for node in ast.walk(call) if isinstance(node, ast.Name)} - {"pd", "pandas"}
+        used |= {(node.value.id, _constant_key(node)) for node in ast.walk(call)
+                 if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)}
+        # Only data that is never reassigned or modified gives the same result every time
+        if used & bound or any(isinstance(node, (ast.Call, ast.Lambda)) for node in ast.walk(call)
+                               if node is not call):
+            continue
+        names[key] = f"{HOISTED_PREFIX}{len(names)}"
+    if not names:
+        return 0
+
+    first_use = {key: occurrences[key][0][0] for key in names}
+    body = []
+    replaced = 0
+    for index, statement in enumerate(tree.body):
+        for key in names:
+            if first_use[key] == index:
+                body.append(ast.Assign(targets=[ast.Name(id=names[key], ctx=ast.Store())],
+                                       value=occurrences[key][0][1], lineno=0))
+        # Calls before the first unconditional one keep running on their own
+        active = {key: name for key, name in names.items() if first_use[key] <= index}
+        if active:
+            replaced += sum(1 for node in ast.walk(statement)
+                            if isinstance(node, ast.Call) and ast.dump(node) in active)
+            statement = _ReplaceCalls(active).visit(statement)
+        body.append(statement)
+    tree.body = body
+    return replaced
+
+
+def analyze(code):
+    """Find slow patterns and apply the safe rewrites; unparsable code is returned as is."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return Analysis(code)
+    found = _find(tree)
+    rewrites = Counter()
+    if found.get("apply_axis1"):
+        rewriter = _RowApplyRewriter()
+        tree = rewriter.visit(tree)
+        if rewriter.rewrites:
+            rewrites["apply_axis1"] = rewriter.rewrites
+    if found.get("repeated_to_datetime"):
+        hoisted = _hoist_to_datetime(tree)
+        if hoisted:
+            rewrites["repeated_to_datetime"] = hoisted
+    if rewrites:
+        tree = ast.fix_missing_locations(tree)
+        code = ast.unparse(tree)
+        remaining = _find(tree)
+    else:
+        remaining = found
+    with _stats_lock:
+        _flagged.update(found)
+        _rewritten.update(rewrites)
+    return Analysis(code, dict(remaining), dict(rewrites))
+
+
+def gate(code, regenerate=None):
+    """Analyze generated code, asking `regenerate(feedback)` for new code at most once.
+
+    `regenerate` returns raw model text for the prompt plus feedback. Returns
+    the Analysis of the code to run.
+    """
+    global _regenerations
+    analysis = analyze(code)
+    if analysis.issues and regenerate is not None:
+        logger.info("Regenerating code with slow patterns: %s", analysis.issues)
+        with _stats_lock:
+            _regenerations += 1
+        analysis = analyze(clean_generated_code(regenerate(analysis.feedback())))
+        analysis.regenerated = True
+    return analysis
+
+
+def code_hash(code):
+    return hashlib.blake2b(code.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def compile_cached(code):
+    """Compiled code object for `code`, compiled once per process."""
+    key = code_hash(code)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = compile(code, f"<generated {key[:8]}>", "exec")
+        _compiled.put(key, compiled)
+    return compiled
+
+
+def stats():
+    """Per-pattern counts: flagged, rewritten; plus regenerations and compile-cache stats."""
+    with _stats_lock:
+        return {
+            "flagged": dict(_flagged),
+            "rewritten": dict(_rewritten),
+            "regenerations": _regenerations,
+            "compiled": _compiled.stats(),
+        }
+
+
+def stats_summary():
+    counts = stats()
+    if not counts["flagged"]:
+        return "no slow patterns seen"
+    parts = [
+        f"{pattern} {flagged} ({counts['rewritten'].get(pattern, 0)} rewritten)"
+        for pattern, flagged in sorted(counts["flagged"].items())
+    ]
+    return ", ".join(parts) + f"; {counts['regenerations']} regenerated"
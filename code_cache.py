@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of generated analysis code.
+
+Code that ran successfully is stored in a local SQLite file keyed by the
+normalized question text and a fingerprint of the columns and dtypes the
+model was shown. A repeated question against the same schema, from any
+session or after a restart, skips the code-generation round trip.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+CACHE_PATH = os.environ.get("CHAT_WITH_DATA_CODE_CACHE", ".code_cache.sqlite3")
+# Total size of stored code before least recently used entries are evicted
+MAX_CACHE_BYTES = 16 * 1024**2
+
+
+def normalize_question(question):
+    """Casefold, collapse whitespace and drop trailing punctuation."""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?!.。？！")
+
+
+def schema_fingerprint(data_dict_text):
+    """Fingerprint of the `column: dtype` listing shown to the model."""
+    return hashlib.blake2b(data_dict_text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CodeCache:
+    """SQLite-backed LRU of generated code, bounded by total code size."""
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        # WAL lets several server processes read while one writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS generated_code (
+                key TEXT PRIMARY KEY,
+                question TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                code TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS generated_code_last_used ON generated_code (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(question, fingerprint):
+        normalized = normalize_question(question)
+        return hashlib.blake2b(f"{fingerprint}\n{normalized}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, question, fingerprint):
+        key = self.make_key(question, fingerprint)
+        with self._lock:
+            row = self._conn.execute("SELECT code FROM generated_code WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE generated_code SET hits = hits + 1, last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, question, fingerprint, code):
+        key = self.make_key(question, fingerprint)
+        size = len(code.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generated_code (key, question, fingerprint, code, size, hits, last_used) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (key, normalize_question(question), fingerprint, code, size, time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM generated_code").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM generated_code ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM generated_code WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generated_code"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """The process-wide cache at CACHE_PATH, opened on first use."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = CodeCache()
+        return _default_cache
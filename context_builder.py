@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Versioned data context of a session, built from per-dataset segments.
+
+The context used to be one string built by concatenation: the data
+dictionary was appended again on every rerun while it was uploaded, and
+the ux_ui app appended each new file's context without ever removing one,
+so the context grew with every interaction.
+
+`DataContext` keeps one segment per uploaded file and one for the
+dictionary, keyed by file name and content hash, so the same bytes
+uploaded under a new name get a segment with that name. Syncing it with
+the session's uploads only builds the text of segments that were added;
+removed ones are dropped. Segment texts are cached per process, so
+sessions sharing a dataset share its text.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import ingestion
+from caching import LRUCache
+
+MAX_CACHED_SEGMENTS = 64
+
+_segment_texts = LRUCache(max_entries=MAX_CACHED_SEGMENTS)
+
+
+@dataclass(frozen=True)
+class Segment:
+    kind: str
+    content_hash: str
+    text: str
+
+
+def dataset_text(name, handle):
+    key = ("dataset", handle.content_hash, name)
+    text = _segment_texts.get(key)
+    if text is None:
+        text = f"File: {name}\n" + ingestion.parsed_for(handle).context_body()
+        _segment_texts.put(key, text)
+    return text
+
+
+def dictionary_text(content_hash, data_dict):
+    key = ("dictionary", content_hash)
+    text = _segment_texts.get(key)
+    if text is None:
+        text = f"Data Dictionary:\n{data_dict.to_string(index=False)}"
+        _segment_texts.put(key, text)
+    return text
+
+
+class DataContext:
+    """Dataset and dictionary segments; `version` changes whenever a segment does."""
+
+    def __init__(self):
+        self._datasets = OrderedDict()
+        self._dictionary = None
+        self.version = 0
+
+    def sync_datasets(self, files):
+        """Match the dataset segments to `files` [(file name, handle)]."""
+        wanted = OrderedDict(((name, handle.content_hash), handle) for name, handle in files)
+        changed = False
+        for key in list(self._datasets):
+            if key not in wanted:
+                del self._datasets[key]
+                changed = True
+        for (name, content_hash), handle in wanted.items():
+            if (name, content_hash) not in self._datasets:
+                self._datasets[(name, content_hash)] = Segment("dataset", content_hash, dataset_text(name, handle))
+                changed = True
+        if changed:
+            self.version += 1
+        return changed
+
+    def set_dictionary(self, content_hash, data_dict):
+        if self._dictionary is not None and self._dictionary.content_hash == content_hash:
+            return False
+        self._dictionary = Segment("dictionary", content_hash, dictionary_text(content_hash, data_dict))
+        self.version += 1
+        return True
+
+    def clear_dictionary(self):
+        if self._dictionary is None:
+            return False
+        self._dictionary = None
+        self.version += 1
+        return True
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""Pre-aggregated cubes for group-by questions over low-cardinality columns.
+
+Most questions are sums, counts and means of a few numeric columns grouped
+by one or two categorical ones, and each used to scan the whole dataset in
+the generated code. After upload, a background thread builds small cubes:
+for every dimension pair (or single dimension) the per-group row count and
+the sum, count, min and max of every numeric measure.
+
+`answer` checks generated code before execution. When the code is a single
+`ANSWER = df.groupby(...)[...].<agg>()` over cube columns, optionally
+followed by plain methods such as `reset_index()` or `sort_values(...)`,
+the cube rows are grouped again with the same `groupby` arguments and the
+partial aggregates combined. Grouping the cube rather than rebuilding the
+result by hand keeps pandas' semantics for sorting, missing keys and
+unobserved categories identical to a run on the full frame; only float
+sums may differ in the last digits. Anything else runs as usual.
+"""
+
+import ast
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import dataset_store
+import ingestion
+from caching import LRUCache
+
+# Columns with at most this many distinct values are dimensions
+MAX_DIM_CARDINALITY = 50
+MAX_DIMS = 8
+MAX_MEASURES = 32
+# Dimension pairs whose cube could exceed this many groups are not combined
+MAX_CUBE_CELLS = 20_000
+MAX_CUBE_BYTES = 256 * 1024**2
+
+AGGREGATES = ("sum", "count", "mean", "min", "max", "size")
+# Methods applied to the aggregated result as written in the code
+RESULT_METHODS = {
+    "reset_index", "sort_values", "sort_index", "head", "tail", "nlargest", "nsmallest", "round", "rename",
+    "to_frame",
+}
+GROUPBY_OPTIONS = {"sort", "dropna", "observed", "as_index"}
+_DIMENSION_DTYPES = ("object", "category", "bool", "string")
+_PARTIALS = ("sum", "count", "min", "max")
+_ROWS = "\x1frows"
+_IMPORTS = {"pandas", "numpy"}
+
+logger = logging.getLogger(__name__)
+
+
+def _partial(measure, aggregate):
+    return f"{measure}\x1f{aggregate}"
+
+
+@dataclass
+class Cube:
+    dims: tuple
+    measures: tuple
+    frame: object
+
+    @property
+    def nbytes(self):
+        return int(self.frame.memory_usage(deep=True, index=True).sum())
+
+
+@dataclass
+class CubeSet:
+    cubes: list
+    build_seconds: float
+
+    @property
+    def nbytes(self):
+        return sum(cube.nbytes for cube in self.cubes)
+
+
+@dataclass
+class CubeHit:
+    """Stands in for ExecutionStats when a question was answered from a cube."""
+
+    answer: object
+    dims: tuple
+    cube_rows: int
+    seconds: float
+
+    def summary(self):
+        return (
+            f"answered from the {' × '.join(self.dims)} cube ({self.cube_rows:,} groups) "
+            f"in {self.seconds * 1000:.1f}ms without scanning the dataset"
+        )
+
+
+_cubes = LRUCache(max_entries=64, max_bytes=MAX_CUBE_BYTES, sizeof=lambda cube_set: cube_set.nbytes)
+_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cube-builder")
+_pending = set()
+_stats_lock = threading.Lock()
+_counters = Counter()
+_build_seconds = 0.0
+
+
+def _is_integer(dtype):
+    return dtype.startswith(("int", "uint"))
+
+
+def plan(profile):
+    """(dimension columns, measure columns) for a dataset profile."""
+    dims = [
+        column for column in profile.columns
+        if 2 <= column.distinct <= MAX_DIM_CARDINALITY
+        and (column.dtype in _DIMENSION_DTYPES or _is_integer(column.dtype))
+    ]
+    dims = sorted(dims, key=lambda column: column.distinct)[:MAX_DIMS]
+    dim_names = {column.name for column in dims}
+    measures = [
+        column.name for column in profile.columns
+        if column.name not in dim_names and (_is_integer(column.dtype) or column.dtype.startswith("float"))
+    ][:MAX_MEASURES]
+    return dims, measures
+
+
+def _groupings(dims):
+    """Dimension pairs that stay small, plus single dimensions not in any pair."""
+    groupings = []
+    paired = set()
+    for i, first in enumerate(dims):
+        for second in dims[i + 1:]:
+            if first.distinct * second.distinct <= MAX_CUBE_CELLS:
+                groupings.append((first.name, second.name))
+                paired.update((first.name, second.name))
+    groupings += [(column.name,) for column in dims if column.name not in paired]
+    return groupings
+
+
+def build_cube(df, dims, measures):
+    grouped = df.groupby(list(dims), observed=True, dropna=False, sort=False)
+    parts = {_ROWS: grouped.size()}
+    if measures:
+        aggregated = grouped[list(measures)].agg(list(_PARTIALS))
+        for measure, aggregate in aggregated.columns:
+            parts[_partial(measure, aggregate)] = aggregated[(measure, aggregate)]
+    return Cube(tuple(dims), tuple(measures), pd.DataFrame(parts).reset_index())
+
+
+def build(handle):
+    """Build and keep the cubes of a stored dataset."""
+    global _build_seconds
+    started = time.perf_counter()
+    dims, measures = plan(ingestion.get_profile(handle))
+    df = dataset_store.open_dataframe(handle)
+    cubes = [build_cube(df, grouping, measures) for grouping in _groupings(dims)]
+    cube_set = CubeSet(cubes, time.perf_counter() - started)
+    _cubes.put(handle.content_hash, cube_set)
+    with _stats_lock:
+        _counters["builds"] += 1
+        _build_seconds += cube_set.build_seconds
+    logger.info(
+        "Built %d cubes for %s in %.2fs (%d bytes)",
+        len(cubes), handle.content_hash, cube_set.build_seconds, cube_set.nbytes,
+    )
+    return cube_set
+
+
+def _build_in_background(handle):
+    try:
+        build(handle)
+    except Exception:
+        logger.exception("Building cubes for %s failed", handle.content_hash)
+    finally:
+        with _stats_lock:
+            _pending.discard(handle.content_hash)
+
+
+def schedule_build(handle):
+    """Build a dataset's cubes on the background thread unless built or queued."""
+    with _stats_lock:
+        if handle.content_hash in _pending or handle.content_hash in _cubes:
+            return
+        _pending.add(handle.content_hash)
+    _builder.submit(_build_in_background, handle)
+
+
+@dataclass
+class _Query:
+    by: object
+    options: dict
+    measures: object
+    aggregate: str
+    methods: list
+
+
+def _literal(node):
+    return ast.literal_eval(node)
+
+
+def _parse(code, df_name):
+    """The group-by aggregation in `code`, or None if the code does anything else."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    statements = [
+        statement for statement in tree.body
+        if not (isinstance(statement, ast.Import) and all(alias.name in _IMPORTS for alias in statement.names))
+    ]
+    if len(statements) != 1 or not isinstance(statements[0], ast.Assign):
+        return None
+    assign = statements[0]
+    if len(assign.targets) != 1 or not isinstance(assign.targets[0], ast.Name) or assign.targets[0].id != "ANSWER":
+        return None
+
+    try:
+        # Trailing result methods, outermost first
+        node = assign.value
+        methods = []
+        while isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in RESULT_METHODS:
+            args = [_literal(arg) for arg in node.args]
+            kwargs = {keyword.arg: _literal(keyword.value) for keyword in node.keywords}
+            methods.append((node.func.attr, args, kwargs))
+            node = node.func.value
+        methods.reverse()
+
+        # The aggregation: .sum() or .agg("sum")
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)):
+            return None
+        aggregate = node.func.attr
+        if aggregate in ("agg", "aggregate"):
+            if len(node.args) != 1 or node.keywords:
+                return None
+            aggregate = _literal(node.args[0])
+        elif node.args or node.keywords:
+            return None
+        if aggregate not in AGGREGATES:
+            return None
+        node = node.func.value
+
+        # Selected measures: ["col"], [["a", "b"]] or .col
+        measures = None
+        if isinstance(node, ast.Subscript):
+            measures = _literal(node.slice)
+            node = node.value
+        elif isinstance(node, ast.Attribute):
+            measures = node.attr
+            node = node.value
+        if isinstance(measures, list) and not all(isinstance(measure, str) for measure in measures):
+            return None
+        if measures is not None and not isinstance(measures, (str, list)):
+            return None
+        if (measures is None) != (aggregate == "size"):
+            return None
+
+        # df.groupby(by, **options)
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "groupby"):
+            return None
+        if not (isinstance(node.func.value, ast.Name) and node.func.value.id == df_name):
+            return None
+        options = {}
+        by = _literal(node.args[0]) if node.args else None
+        if len(node.args) > 1:
+            return None
+        for keyword in node.keywords:
+            if keyword.arg == "by" and by is None:
+                by = _literal(keyword.value)
+            elif keyword.arg in GROUPBY_OPTIONS:
+                options[keyword.arg] = _literal(keyword.value)
+            else:
+                return None
+    except (ValueError, TypeError, SyntaxError):
+        # A non-literal argument
+        return None
+    if isinstance(by, list) and by and all(isinstance(dim, str) for dim in by):
+        pass
+    elif not isinstance(by, str):
+        return None
+    return _Query(by, options, measures, aggregate, methods)
+
+
+def _find_cube(cube_set, dims, measures):
+    matches = [
+        cube for cube in cube_set.cubes
+        if set(dims) <= set(cube.dims) and set(measures) <= set(cube.measures)
+    ]
+    return min(matches, key=lambda cube: len(cube.frame), default=None)
+
+
+def _evaluate(query, cube):
+    options = dict(query.options)
+    as_index = options.pop("as_index", True)
+    grouped = cube.frame.groupby(query.by, **options)
+    measures = [query.measures] if isinstance(query.measures, str) else list(query.measures or [])
+    if query.aggregate == "size":
+        result = grouped[_ROWS].sum()
+        result.name = None
+    elif query.aggregate == "mean":
+        sums = grouped[[_partial(measure, "sum") for measure in measures]].sum()
+        counts = grouped[[_partial(measure, "count") for measure in measures]].sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = sums.to_numpy(dtype=np.float64) / counts.to_numpy(dtype=np.float64)
+        result = pd.DataFrame(values, index=sums.index, columns=measures)
+    else:
+        # Counts add up like sums; min and max of partial mins and maxes
+        combine = "sum" if query.aggregate in ("sum", "count") else query.aggregate
+        columns = [_partial(measure, query.aggregate) for measure in measures]
+        result = getattr(grouped[columns], combine)()
+        result.columns = measures
+    if isinstance(query.measures, str):
+        result = result[query.measures]
+    if not as_index:
+        result = result.reset_index(name="size") if query.aggregate == "size" else result.reset_index()
+    for method, args, kwargs in query.methods:
+        result = getattr(result, method)(*args, **kwargs)
+    return result
+
+
+def answer(code, handle, df_name="df"):
+    """A CubeHit when `code` can be answered from the dataset's cubes, else None."""
+    cube_set = _cubes.get(handle.content_hash)
+    if cube_set is None:
+        return None
+    started = time.perf_counter()
+    with _stats_lock:
+        _counters["lookups"] += 1
+    query = _parse(code, df_name)
+    if query is None:
+        return None
+    dims = [query.by] if isinstance(query.by, str) else query.by
+    measures = [query.measures] if isinstance(query.measures, str) else list(query.measures or [])
+    cube = _find_cube(cube_set, dims, measures)
+    if cube is None:
+        return None
+    try:
+        result = _evaluate(query, cube)
+    except Exception as e:
+        # Whatever the cube cannot reproduce runs on the full data instead
+        logger.info("Cube evaluation failed, running the code: %s", e)
+        return None
+    with _stats_lock:
+        _counters["hits"] += 1
+    return CubeHit(result, cube.dims, len(cube.frame), time.perf_counter() - started)
+
+
+def stats():
+    cube_count = 0
+    for _, cube_set in _cubes.items():
+        cube_count += len(cube_set.cubes)
+    with _stats_lock:
+        lookups = _counters["lookups"]
+        return {
+            "datasets": len(_cubes),
+            "cubes": cube_count,
+            "bytes": _cubes.total_bytes,
+            "builds": _counters["builds"],
+            "build_seconds": _build_seconds,
+            "pending": len(_pending),
+            "lookups": lookups,
+            "hits": _counters["hits"],
+            "hit_rate": _counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+def summary():
+    counts = stats()
+    return (
+        f"{counts['cubes']} cubes for {counts['datasets']} datasets ({counts['bytes'] / 1024**2:,.1f} MB, "
+        f"built in {counts['build_seconds']:.1f}s, {counts['pending']} pending); "
+        f"{counts['hits']} / {counts['lookups']} questions answered from cubes ({counts['hit_rate']:.0%})"
+    )
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Indexed data dictionary for fast column lookup per question.
+
+The uploaded dictionary CSV used to be dumped whole into the context with
+`to_string()`. It is now parsed once per upload into entries (column name,
+definition, value labels, synonyms) and an inverted index from tokens to
+column names. Each question is looked up against the index, and only the
+matching columns and their definitions go into code generation.
+
+Built-in synonym groups link common Thai and English terms, so "ยอดขาย"
+finds a column described as "sales amount" and vice versa.
+"""
+
+from dataclasses import dataclass
+
+from caching import LRUCache
+from text_index import InvertedIndex, tokenize
+
+# Header keywords used to recognise the dictionary's own columns
+NAME_HEADERS = ("column", "field", "variable", "attribute", "name", "คอลัมน์", "ตัวแปร", "ชื่อ")
+DEFINITION_HEADERS = ("description", "definition", "meaning", "detail", "desc", "คำอธิบาย", "ความหมาย", "รายละเอียด")
+VALUE_HEADERS = ("value", "label", "code", "ค่า")
+SYNONYM_HEADERS = ("synonym", "alias", "keyword", "คำพ้อง", "คำค้น")
+
+SYNONYM_GROUPS = [
+    ("sales", "sale", "revenue", "income", "amount", "ยอดขาย", "รายได้", "ยอด"),
+    ("customer", "client", "member", "ลูกค้า", "สมาชิก"),
+    ("date", "day", "time", "วันที่", "วัน", "เวลา"),
+    ("month", "เดือน"),
+    ("year", "ปี"),
+    ("province", "state", "จังหวัด"),
+    ("region", "area", "zone", "ภูมิภาค", "ภาค", "พื้นที่"),
+    ("branch", "store", "shop", "สาขา", "ร้าน"),
+    ("product", "item", "sku", "สินค้า", "ผลิตภัณฑ์"),
+    ("category", "type", "group", "segment", "ประเภท", "หมวด", "กลุ่ม"),
+    ("price", "cost", "ราคา", "ต้นทุน"),
+    ("quantity", "qty", "count", "units", "จำนวน"),
+    ("age", "อายุ"),
+    ("gender", "sex", "เพศ"),
+    ("male", "ชาย"),
+    ("female", "หญิง"),
+    ("status", "สถานะ"),
+    ("channel", "ช่องทาง"),
+    ("discount", "ส่วนลด"),
+    ("profit", "margin", "กำไร"),
+    ("id", "code", "number", "รหัส", "หมายเลข"),
+]
+
+MAX_DICTIONARIES = 8
+
+_parsed = LRUCache(max_entries=MAX_DICTIONARIES)
+
+
+@dataclass
+class DictionaryEntry:
+    column: str
+    definition: str = ""
+    value_labels: str = ""
+    synonyms: str = ""
+
+    def describe(self):
+        text = self.definition
+        if self.value_labels:
+            text += f" (values: {self.value_labels})" if text else f"values: {self.value_labels}"
+        return text
+
+
+def _synonym_tokens(text):
+    """Marker tokens for every synonym group mentioned in `text`."""
+    lowered = str(text).lower()
+    words = set(tokenize(lowered))
+    markers = []
+    for group_id, group in enumerate(SYNONYM_GROUPS):
+        for term in group:
+            # Thai terms are matched as substrings since Thai has no spaces
+            if (term in words) if term.isascii() else (term in lowered):
+                markers.append(f"syn:{group_id}")
+                break
+    return markers
+
+
+def _find_header(headers, keywords, exclude=()):
+    for keyword in keywords:
+        for header in headers:
+            if header not in exclude and keyword in header.lower():
+                return header
+    return None
+
+
+class DataDictionary:
+    def __init__(self, entries):
+        self.entries = {entry.column: entry for entry in entries}
+        self.index = InvertedIndex()
+        for entry in entries:
+            text = f"{entry.column} {entry.definition} {entry.synonyms}"
+            # Column names weigh more than free-text definitions
+            self.index.add(entry.column, entry.column, weight=3)
+            self.index.add_tokens(entry.column, tokenize(f"{entry.definition} {entry.synonyms}"))
+            self.index.add_tokens(entry.column, _synonym_tokens(text), weight=2)
+            if entry.value_labels:
+                self.index.add(entry.column, entry.value_labels)
+
+    @classmethod
+    def from_frame(cls, data_dict):
+        """Parse a dictionary DataFrame, recognising its columns by header."""
+        headers = [str(header) for header in data_dict.columns]
+        if not headers:
+            return cls([])
+        frame = data_dict.copy()
+        frame.columns = headers
+        name_col = _find_header(headers, NAME_HEADERS) or headers[0]
+        definition_col = _find_header(headers, DEFINITION_HEADERS, exclude=(name_col,))
+        value_col = _find_header(headers, VALUE_HEADERS, exclude=(name_col, definition_col))
+        synonym_col = _find_header(headers, SYNONYM_HEADERS, exclude=(name_col, definition_col, value_col))
+        if definition_col is None:
+            # Unrecognised layout: everything but the name is the definition
+            others = [header for header in headers if header not in (name_col, value_col, synonym_col)]
+        else:
+            others = [definition_col]
+
+        def cell(row, header):
+            value = row.get(header) if header else None
+            return "" if value is None or value != value else str(value).strip()
+
+        entries = []
+        for row in frame.to_dict("records"):
+            column = cell(row, name_col)
+            if not column:
+                continue
+            entries.append(DictionaryEntry(
+                column=column,
+                definition=" ".join(text for text in (cell(row, header) for header in others) if text),
+                value_labels=cell(row, value_col),
+                synonyms=cell(row, synonym_col),
+            ))
+        return cls(entries)
+
+    def lookup(self, question, columns=None, limit=None):
+        """Dictionary entries matching the question, best first.
+
+        `columns` restricts matches to columns present in a dataset.
+        """
+        tokens = tokenize(question) + _synonym_tokens(question)
+        matches = []
+        for column, score in self.index.search_tokens(tokens):
+            if columns is not None and column not in columns:
+                continue
+            matches.append((self.entries[column], score))
+            if limit and len(matches) >= limit:
+                break
+        return matches
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def load(content_hash, data_dict):
+    """The parsed dictionary for an upload, built once per content hash."""
+    dictionary = _parsed.get(content_hash)
+    if dictionary is None:
+        dictionary = DataDictionary.from_frame(data_dict)
+        _parsed.put(content_hash, dictionary)
+    return dictionary
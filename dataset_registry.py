@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Server-wide registry of the datasets sessions are using.
+
+Identical uploads already share one stored Arrow file and one parsed entry
+with its profile, because `ingestion` and `dataset_store` key everything by
+content hash. What was missing is knowing which sessions still use a
+dataset: the open-frame and profile caches were bounded only by entry
+count, so a dataset in active use could be dropped while idle ones stayed
+resident.
+
+Each session holds a lease on the datasets in its upload list, renewed on
+every rerun. Streamlit does not tell us when a session ends, so a lease
+also expires after LEASE_SECONDS without a rerun. A dataset without leases
+is forgotten after TTL_SECONDS idle. When open frames use more than
+MAX_RESIDENT_BYTES of server memory, the least recently used ones are
+closed, unleased datasets first; closed datasets reopen memory-mapped on
+their next use. Worker processes keep their own open frames and are not
+counted here.
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+import dataset_store
+import ingestion
+
+LEASE_SECONDS = float(os.environ.get("CHAT_WITH_DATA_REGISTRY_LEASE", 30 * 60))
+TTL_SECONDS = float(os.environ.get("CHAT_WITH_DATA_REGISTRY_TTL", 60 * 60))
+MAX_RESIDENT_BYTES = int(os.environ.get("CHAT_WITH_DATA_REGISTRY_BYTES", 2 * 1024**3))
+
+
+@dataclass
+class RegistryEntry:
+    handle: object
+    parsed: object
+    names: set = field(default_factory=set)
+    # session id -> time of its last rerun using this dataset
+    leases: dict = field(default_factory=dict)
+    last_used: float = 0.0
+
+
+class DatasetRegistry:
+    """Reference-counted view over the shared dataset caches."""
+
+    def __init__(self, max_resident_bytes=MAX_RESIDENT_BYTES, lease_seconds=LEASE_SECONDS, ttl_seconds=TTL_SECONDS):
+        self.max_resident_bytes = max_resident_bytes
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.closes = 0
+
+    def sync(self, session_id, files, now=None):
+        """Set the datasets `session_id` uses to `files` [(file name, handle)]."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            current = set()
+            for name, handle in files:
+                key = handle.content_hash
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = RegistryEntry(handle, ingestion.parsed_for(handle))
+                    self._entries[key] = entry
+                else:
+                    # Keep the shared profile even if the count-bounded cache dropped it
+                    ingestion.retain(entry.parsed)
+                entry.names.add(name)
+                entry.leases[session_id] = now
+                entry.last_used = now
+                current.add(key)
+            for key, entry in self._entries.items():
+                if key not in current:
+                    entry.leases.pop(session_id, None)
+            self._enforce(now)
+
+    def _enforce(self, now):
+        for key, entry in list(self._entries.items()):
+            entry.leases = {
+                session_id: seen for session_id, seen in entry.leases.items() if now - seen <= self.lease_seconds
+            }
+            if not entry.leases and now - entry.last_used > self.ttl_seconds:
+                dataset_store.close(key)
+                ingestion.forget(key)
+                del self._entries[key]
+                self.evictions += 1
+        # Store files of registered datasets survive pruning until they are forgotten
+        dataset_store.set_leased(self._entries)
+
+        resident = dataset_store.opened_resident_bytes()
+        total = sum(resident.values())
+        if total <= self.max_resident_bytes:
+            return
+
+        def close_order(key):
+            entry = self._entries.get(key)
+            if entry is None:
+                return (False, 0.0)
+            return (bool(entry.leases), entry.last_used)
+
+        for key in sorted(resident, key=close_order):
+            if total <= self.max_resident_bytes:
+                break
+            if dataset_store.close(key):
+                total -= resident[key]
+                self.closes += 1
+
+    def snapshot(self, now=None):
+        """One row per registered dataset, most recently used first."""
+        now = now if now is not None else time.time()
+        resident = dataset_store.opened_resident_bytes()
+        mb = 1024**2
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda item: -item[1].last_used)
+            return [
+                {
+                    "dataset": ", ".join(sorted(entry.names)),
+                    "hash": key[:8],
+                    "rows": entry.handle.num_rows,
+                    "sessions": sum(1 for seen in entry.leases.values() if now - seen <= self.lease_seconds),
+                    "resident_mb": round(resident.get(key, 0) / mb, 1),
+                    "mapped_mb": round(entry.handle.mapped_bytes / mb, 1),
+                    "idle_s": int(now - entry.last_used),
+                }
+                for key, entry in entries
+            ]
+
+    def totals(self):
+        resident = dataset_store.opened_resident_bytes()
+        with self._lock:
+            sessions = set()
+            for entry in self._entries.values():
+                sessions.update(entry.leases)
+            return {
+                "datasets": len(self._entries),
+                "sessions": len(sessions),
+                "resident_bytes": sum(resident.values()),
+                "mapped_bytes": sum(entry.handle.mapped_bytes for entry in self._entries.values()),
+                "budget_bytes": self.max_resident_bytes,
+                "evictions": self.evictions,
+                "closes": self.closes,
+            }
+
+    def summary(self):
+        totals = self.totals()
+        mb = 1024**2
+        return (
+            f"{totals['datasets']} datasets for {totals['sessions']} sessions, "
+            f"{totals['resident_bytes'] / mb:,.0f} of {totals['budget_bytes'] / mb:,.0f} MB resident, "
+            f"{totals['mapped_bytes'] / mb:,.0f} MB mapped"
+        )
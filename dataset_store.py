@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""On-disk columnar store for uploaded datasets.
+
+Each upload is written once as an uncompressed Arrow IPC file named after
+its content hash. Sessions keep only a `DatasetHandle`; the data is opened
+memory-mapped when it is needed, so numeric columns without nulls are
+zero-copy views over the page cache and server memory follows the working
+set rather than the number of open sessions.
+"""
+
+import os
+import tempfile
+from dataclasses import dataclass
+
+import numpy as np
+import pyarrow as pa
+
+from caching import LRUCache
+
+STORE_DIR = os.environ.get("CHAT_WITH_DATA_STORE", ".dataset_store")
+# Store files beyond this total are removed, least recently opened first
+MAX_STORE_BYTES = 20 * 1024**3
+# Opened frames kept per process; only non-mapped columns cost resident memory
+MAX_OPEN_DATASETS = 4
+
+
+@dataclass(frozen=True)
+class DatasetHandle:
+    content_hash: str
+    path: str
+    num_rows: int
+    num_columns: int
+    mapped_bytes: int
+
+
+class OpenedDataset:
+    """A memory-mapped frame plus how much of it is actually resident."""
+
+    def __init__(self, table, df, mapping=None):
+        self.table = table
+        self.df = df
+        self.resident_bytes = resident_bytes(df, mapping)
+
+
+_opened = LRUCache(max_entries=MAX_OPEN_DATASETS)
+# Content hashes some session still uses (see dataset_registry); never pruned
+_leased = frozenset()
+
+
+def _path_for(content_hash):
+    return os.path.join(STORE_DIR, f"{content_hash}.arrow")
+
+
+def _handle_for(content_hash, path):
+    with pa.memory_map(path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        num_rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+        num_columns = len(reader.schema.names)
+    return DatasetHandle(content_hash, path, num_rows, num_columns, os.path.getsize(path))
+
+
+def get(content_hash):
+    """Return the handle of an already stored dataset, or None."""
+    path = _path_for(content_hash)
+    if not os.path.exists(path):
+        return None
+    return _handle_for(content_hash, path)
+
+
+def put(content_hash, df):
+    """Convert a frame to Arrow IPC once and return its handle."""
+    path = _path_for(content_hash)
+    if os.path.exists(path):
+        return _handle_for(content_hash, path)
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    table = _to_table(df)
+    # Write to a temp file first so concurrent sessions never map a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=STORE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    prune()
+    return DatasetHandle(content_hash, path, table.num_rows, table.num_columns, os.path.getsize(path))
+
+
+def _to_table(df):
+    """Arrow table of `df`; object columns with values of several types are stored as text."""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    mixed = df.copy(deep=False)
+    for position in range(mixed.shape[1]):
+        series = mixed.iloc[:, position]
+        if series.dtype == object and series.dropna().map(type).nunique() > 1:
+            # e.g. numbers and strings in one column of a messy CSV
+            mixed.isetitem(position, series.where(series.isna(), series.astype(str)))
+    return pa.Table.from_pandas(mixed, preserve_index=False)
+
+
+def set_leased(content_hashes):
+    """Record the datasets sessions still use, so `prune` keeps their files."""
+    global _leased
+    _leased = frozenset(content_hashes)
+
+
+def open_dataset(handle):
+    """Open a stored dataset memory-mapped; recently used ones stay open."""
+    opened = _opened.get(handle.content_hash)
+    if opened is None:
+        source = pa.memory_map(handle.path, "r")
+        table = pa.ipc.open_file(source).read_all()
+        # split_blocks keeps one block per column so compatible columns stay
+        # zero-copy views of the mapping instead of being consolidated
+        df = table.to_pandas(split_blocks=True)
+        # A zero-copy read of the whole file: its address range is the mapping
+        source.seek(0)
+        mapping = source.read_buffer()
+        opened = OpenedDataset(table, df, (mapping.address, mapping.address + mapping.size))
+        _opened.put(handle.content_hash, opened)
+        os.utime(handle.path)
+    return opened
+
+
+def open_dataframe(handle):
+    return open_dataset(handle).df
+
+
+def open_table(handle):
+    """The stored dataset as a memory-mapped Arrow table, without pandas conversion."""
+    opened = _opened.peek(handle.content_hash)
+    if opened is not None:
+        return opened.table
+    return pa.ipc.open_file(pa.memory_map(handle.path, "r")).read_all()
+
+
+def close(content_hash):
+    """Drop an opened frame; the file stays in the store and reopens on demand."""
+    return _opened.pop(content_hash) is not None
+
+
+def opened_resident_bytes():
+    """content hash -> resident bytes of each currently open dataset."""
+    return {content_hash: opened.resident_bytes for content_hash, opened in _opened.items()}
+
+
+def resident_bytes(df, mapping=None):
+    """Bytes of `df` held on the heap, i.e. not inside `mapping` (start, end address)."""
+    usage = df.memory_usage(deep=True, index=True)
+    total = int(usage.get("Index", 0))
+    for position in range(df.shape[1]):
+        values = df.iloc[:, position].values
+        # Read-only flags say nothing here: with copy-on-write every `.values` is
+        # read-only, so only arrays whose data lies inside the mapping are skipped
+        if mapping is not None and isinstance(values, np.ndarray) and values.size:
+            address = values.__array_interface__["data"][0]
+            if mapping[0] <= address < mapping[1]:
+                continue
+        total += int(usage.iloc[position + 1])
+    return total
+
+
+def prune(max_bytes=MAX_STORE_BYTES):
+    """Delete least recently opened store files until the store fits."""
+    if not os.path.isdir(STORE_DIR):
+        return
+    entries = []
+    for name in os.listdir(STORE_DIR):
+        if name.endswith(".arrow"):
+            path = os.path.join(STORE_DIR, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        content_hash = os.path.basename(path)[:-len(".arrow")]
+        # Samples are stored as "<content hash>-sample<rows>"
+        if content_hash in _opened or content_hash.split("-")[0] in _leased:
+            continue
+        os.remove(path)
+        total -= size
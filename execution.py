@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Running generated analysis code against an uploaded dataset.
+
+The generated code used to receive `df.copy()`, a full deep copy of the
+dataset for every question. It now receives a protected view instead:
+
+* "view" (default): with pandas copy-on-write enabled, a shallow copy that
+  shares all column data with the original; a column is only copied if the
+  generated code actually writes to it. On pandas without copy-on-write
+  the shared arrays are made read-only so writes fail instead of leaking
+  into the cached dataset.
+* "copy": the previous deep copy, kept for comparison.
+
+Set CHAT_WITH_DATA_EXEC_MODE to pick the mode and CHAT_WITH_DATA_TRACE_MEMORY=1
+to record peak Python/NumPy allocations per run with tracemalloc. Code is
+compiled once per process and code hash (`code_analysis.compile_cached`).
+"""
+
+import logging
+import os
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import code_analysis
+
+EXECUTION_MODE = os.environ.get("CHAT_WITH_DATA_EXEC_MODE", "view")
+TRACE_MEMORY = os.environ.get("CHAT_WITH_DATA_TRACE_MEMORY") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ExecutionStats:
+    mode: str
+    copy_seconds: float
+    exec_seconds: float
+    peak_bytes: int = None
+
+    def summary(self):
+        text = f"data prepared in {self.copy_seconds * 1000:.1f} ms ({self.mode}), ran in {self.exec_seconds:.2f}s"
+        if self.peak_bytes is not None:
+            text += f", peak {self.peak_bytes / 1024**2:,.1f} MB"
+        return text
+
+
+def enable_copy_on_write():
+    """Turn on pandas copy-on-write; returns False on pandas < 2.0."""
+    try:
+        pd.set_option("mode.copy_on_write", True)
+        return True
+    except (KeyError, pd.errors.OptionError):
+        return False
+
+
+def copy_on_write_enabled():
+    try:
+        return bool(pd.get_option("mode.copy_on_write"))
+    except (KeyError, pd.errors.OptionError):
+        return False
+
+
+def protected_view(df):
+    """A new frame object sharing data with `df` that cannot modify it."""
+    view = df.copy(deep=False)
+    if not copy_on_write_enabled():
+        # Without copy-on-write the blocks are shared, so freeze them
+        for block in view._mgr.blocks:
+            if isinstance(block.values, np.ndarray):
+                block.values.flags.writeable = False
+    return view
+
+
+def run_code(code, df, df_name="df", mode=None):
+    """Execute generated code with `df_name` bound to the dataset.
+
+    Returns the local variables after execution and an ExecutionStats.
+    """
+    mode = mode or EXECUTION_MODE
+    tracing = TRACE_MEMORY and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        data = df.copy() if mode == "copy" else protected_view(df)
+        prepared = time.perf_counter()
+        local_vars = {df_name: data, "pd": pd}
+        exec(code_analysis.compile_cached(code), {}, local_vars)
+        finished = time.perf_counter()
+        peak_bytes = tracemalloc.get_traced_memory()[1] if tracing else None
+    finally:
+        if tracing:
+            tracemalloc.stop()
+
+    stats = ExecutionStats(mode, prepared - started, finished - prepared, peak_bytes)
+    logger.info("Executed generated code: %s", stats.summary())
+    return local_vars, stats
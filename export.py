@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Chunked export of full ANSWER values for download.
+
+Results were only ever shown as their first rows or a digest, so getting
+the whole output meant rerunning the analysis in a notebook. `prepare`
+writes a complete ANSWER as CSV, Parquet or Arrow IPC to a file under
+EXPORT_DIR, CHUNK_ROWS rows at a time, so the file is never built as one
+in-memory string or table next to the result. Exports are kept per result
+and format, so reruns and repeated downloads reuse the file; the oldest
+are deleted past MAX_EXPORT_BYTES.
+
+Files are written under Streamlit's `static/` folder and downloaded from
+its static file server (server.enableStaticServing), which streams them
+from disk. `st.download_button` would copy the whole file into server
+memory, so without static serving only files up to MAX_INLINE_BYTES can be
+downloaded.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from caching import LRUCache
+
+# Streamlit serves this folder, next to the app scripts, at app/static/
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+EXPORT_DIR = os.environ.get("CHAT_WITH_DATA_EXPORT_DIR", os.path.join(STATIC_DIR, "exports"))
+CHUNK_ROWS = 100_000
+MAX_EXPORT_FILES = 64
+MAX_EXPORT_BYTES = 2 * 1024**3
+# Largest file handed to st.download_button when static serving is off
+MAX_INLINE_BYTES = 50 * 1024**2
+
+# format -> (MIME type, file extension)
+FORMATS = {
+    "CSV": ("text/csv", ".csv"),
+    "Parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "Arrow": ("application/vnd.apache.arrow.file", ".arrow"),
+}
+
+
+class ExportError(RuntimeError):
+    """The result cannot be written in the requested format; the message is user-facing."""
+
+
+@dataclass(frozen=True)
+class Export:
+    path: str
+    file_name: str
+    mime: str
+    rows: int
+    size_bytes: int
+    seconds: float
+
+    def summary(self):
+        return f"{self.rows:,} rows, {self.size_bytes / 1024**2:,.1f} MB, written in {self.seconds:.2f}s"
+
+
+def _remove(key, export):
+    if os.path.exists(export.path):
+        os.remove(export.path)
+
+
+_exports = LRUCache(
+    max_entries=MAX_EXPORT_FILES, max_bytes=MAX_EXPORT_BYTES, sizeof=lambda export: export.size_bytes,
+    on_evict=_remove,
+)
+
+
+def as_frame(answer):
+    """The tabular form of any ANSWER, without copying frame data."""
+    if isinstance(answer, pd.DataFrame):
+        return answer
+    if isinstance(answer, pd.Series):
+        return answer.to_frame(name=answer.name if answer.name is not None else "value")
+    if isinstance(answer, np.ndarray) and answer.ndim == 2:
+        return pd.DataFrame(answer)
+    if isinstance(answer, dict):
+        return pd.Series(answer, name="value").to_frame()
+    if isinstance(answer, (pd.Index, np.ndarray, list, tuple, set, frozenset)):
+        return pd.DataFrame({"value": list(answer)})
+    return pd.DataFrame({"ANSWER": [answer]})
+
+
+def _chunks(frame, chunk_rows):
+    keep_index = not isinstance(frame.index, pd.RangeIndex)
+    for start in range(0, max(len(frame), 1), chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows]
+        if keep_index:
+            chunk = chunk.reset_index()
+        # Parquet and Arrow need string column names
+        chunk.columns = [str(name) for name in chunk.columns]
+        yield chunk
+
+
+def _write_csv(frame, path, chunk_rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for position, chunk in enumerate(_chunks(frame, chunk_rows)):
+            chunk.to_csv(f, index=False, header=position == 0)
+
+
+def _schema(frame, chunk_rows):
+    """Arrow schema of the whole frame, not just of its first chunk."""
+    schema = pa.Schema.from_pandas(next(_chunks(frame.iloc[:0], chunk_rows)), preserve_index=False)
+    # Object columns of an empty slice have the null type; take the type of
+    # their first non-null values, however late in the frame they come
+    for chunk in _chunks(frame, chunk_rows):
+        pending = [position for position, field in enumerate(schema) if pa.types.is_null(field.type)]
+        if not pending:
+            break
+        for position in pending:
+            inferred = pa.infer_type(chunk.iloc[:, position].values, from_pandas=True)
+            if not pa.types.is_null(inferred):
+                schema = schema.set(position, schema.field(position).with_type(inferred))
+    return schema
+
+
+def _write_arrow_batches(frame, chunk_rows, open_writer):
+    schema = _schema(frame, chunk_rows)
+    writer = open_writer(schema)
+    try:
+        for chunk in _chunks(frame, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        writer.close()
+
+
+def _write_parquet(frame, path, chunk_rows):
+    _write_arrow_batches(frame, chunk_rows, lambda schema: pq.ParquetWriter(path, schema))
+
+
+def _write_arrow(frame, path, chunk_rows):
+    sink = pa.OSFile(path, "wb")
+    try:
+        _write_arrow_batches(frame, chunk_rows, lambda schema: pa.ipc.new_file(sink, schema))
+    finally:
+        sink.close()
+
+
+_WRITERS = {"CSV": _write_csv, "Parquet": _write_parquet, "Arrow": _write_arrow}
+
+
+def static_url(export):
+    """Relative URL of the file on Streamlit's static file server, or None outside STATIC_DIR."""
+    relative = os.path.relpath(os.path.abspath(export.path), STATIC_DIR)
+    if relative.startswith(os.pardir):
+        return None
+    return "app/static/" + relative.replace(os.sep, "/")
+
+
+def export_key(code, dataset_hash, fmt):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{fmt}\n{dataset_hash}\n{code}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get(key):
+    """A previously prepared Export whose file still exists, or None."""
+    export = _exports.get(key)
+    if export is not None and os.path.exists(export.path):
+        return export
+    return None
+
+
+def prepare(answer, fmt, key, base_name="result", chunk_rows=CHUNK_ROWS):
+    """Write `answer` in `fmt` once per `key` (see `export_key`) and return the Export."""
+    export = get(key)
+    if export is not None:
+        return export
+    mime, extension = FORMATS[fmt]
+    frame = as_frame(answer)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    started = time.perf_counter()
+    # Written under a temp name so a failed export never leaves a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, suffix=".tmp")
+    os.close(fd)
+    path = os.path.join(EXPORT_DIR, f"{key}{extension}")
+    try:
+        _WRITERS[fmt](frame, tmp_path, chunk_rows)
+        os.replace(tmp_path, path)
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        raise ExportError(f"The result cannot be exported as {fmt}: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    export = Export(
+        path, f"{base_name}{extension}", mime, len(frame), os.path.getsize(path), time.perf_counter() - started
+    )
+    _exports.put(key, export)
+    return export
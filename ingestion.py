@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Cached CSV ingestion shared by both Streamlit apps.
+
+Every chat message triggers a full Streamlit rerun, which used to re-read
+every uploaded CSV and rebuild its `describe()` context. Parsed files and
+their profiles are now kept in a bounded LRU cache keyed by a hash of the
+file bytes plus the parse options, so a rerun only pays for hashing the
+upload.
+
+The parsed frame itself is not kept here: it is converted once into the
+columnar `dataset_store` and reopened memory-mapped on demand.
+
+Large files are read in chunks with compact dtypes (categoricals, downcast
+numbers, parsed dates) so peak memory stays close to the final frame size.
+"""
+
+import hashlib
+import io
+import re
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from pandas.tseries.api import guess_datetime_format
+
+import dataset_store
+import perf
+import profiler
+from caching import LRUCache
+
+# Parsed files kept per server process (shared by all sessions)
+MAX_CACHED_FILES = 16
+# Uploads at least this large are read in compact chunked mode
+COMPACT_MIN_BYTES = 32 * 1024**2
+CHUNK_ROWS = 250_000
+# Strings with at most this share of distinct values become categoricals
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+# Integer columns within this range become int32 (products of two values still fit)
+INT32_MAX_ABS = 2**15
+DATE_LIKE = re.compile(r"^\s*(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4})")
+
+_cache = LRUCache(max_entries=MAX_CACHED_FILES)
+
+
+class ParsedCSV:
+    """A stored upload; its profile and prompt context are built once, lazily."""
+
+    def __init__(self, handle, report=None):
+        self.handle = handle
+        self.report = report
+        self._profile = None
+
+    @property
+    def content_hash(self):
+        return self.handle.content_hash
+
+    @property
+    def df(self):
+        return dataset_store.open_dataframe(self.handle)
+
+    def profile(self, trace=None):
+        if self._profile is None:
+            with perf.span(trace, "describe"):
+                opened = dataset_store.open_dataset(self.handle)
+                self._profile = profiler.profile_dataframe(
+                    opened.df,
+                    resident_bytes=opened.resident_bytes,
+                    mapped_bytes=self.handle.mapped_bytes,
+                )
+        return self._profile
+
+    def context_body(self):
+        return self.profile().to_context()
+
+
+class IngestedFile:
+    """An uploaded file as seen by one session: its name plus the cached parse."""
+
+    def __init__(self, name, parsed):
+        self.name = name
+        self.parsed = parsed
+
+    @property
+    def content_hash(self):
+        return self.parsed.content_hash
+
+    @property
+    def handle(self):
+        return self.parsed.handle
+
+    @property
+    def df(self):
+        return self.parsed.df
+
+    @property
+    def report(self):
+        return self.parsed.report
+
+    @property
+    def profile(self):
+        return self.parsed.profile()
+
+    @property
+    def context(self):
+        return f"File: {self.name}\n" + self.parsed.context_body()
+
+
+def content_hash(data, read_options=None):
+    """Hash file bytes together with the options used to parse them."""
+    digest = hashlib.blake2b(data, digest_size=16)
+    if read_options:
+        digest.update(repr(sorted(read_options.items())).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class IngestReport:
+    """Before/after memory and timing of a compact chunked read."""
+
+    def __init__(self, rows, seconds, default_bytes, compact_bytes, peak_bytes):
+        self.rows = rows
+        self.seconds = seconds
+        self.default_bytes = default_bytes
+        self.compact_bytes = compact_bytes
+        self.peak_bytes = peak_bytes
+
+    def summary(self):
+        mb = 1024**2
+        return (
+            f"{self.rows:,} rows in {self.seconds:.1f}s, "
+            f"{self.default_bytes / mb:,.1f} MB with default dtypes -> {self.compact_bytes / mb:,.1f} MB compact "
+            f"(peak {self.peak_bytes / mb:,.1f} MB)"
+        )
+
+
+def _plan_compact_dtypes(chunk):
+    """Pick targets for object columns from the first chunk: "category" or ("datetime", format)."""
+    plan = {}
+    for col in chunk.columns[chunk.dtypes == object]:
+        values = chunk[col].dropna()
+        if values.empty:
+            continue
+        sample = values.head(1000).astype(str)
+        if sample.str.match(DATE_LIKE).mean() >= 0.9:
+            date_format = guess_datetime_format(sample.iloc[0])
+            if date_format is not None and _parse_dates(sample, date_format) is not None:
+                plan[col] = ("datetime", date_format)
+                continue
+        if values.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(values):
+            plan[col] = "category"
+    return plan
+
+
+def _downcast_numeric(series):
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        # Never below int32, and only with room for the product of two values:
+        # generated code multiplies columns and narrow integers wrap silently
+        if series.dtype.itemsize > 4 and not series.empty and series.abs().max() < INT32_MAX_ABS:
+            return series.astype(np.int32)
+        return series
+    if series.dtype == np.float64:
+        # Only narrow floats when every value survives the round trip
+        narrowed = series.astype(np.float32)
+        if ((narrowed.astype(np.float64) == series) | series.isna()).all():
+            return narrowed
+    return series
+
+
+def _parse_dates(series, date_format):
+    """`series` as datetimes if every value parses and formats back to itself, else None.
+
+    The round trip means a column can still be turned back into exactly the
+    strings read_csv would have kept, should a later chunk not parse.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        parsed = pd.to_datetime(series, format=date_format, errors="coerce")
+    present = series.notna()
+    if not (parsed.notna() == present).all():
+        return None
+    if not (parsed[present].dt.strftime(date_format) == series[present]).all():
+        return None
+    return parsed
+
+
+def _compact_chunk(chunk, plan):
+    columns = {}
+    for col in chunk.columns:
+        series = chunk[col]
+        target = plan.get(col)
+        if target == "category" and series.dtype == object:
+            series = series.astype("category")
+        elif isinstance(target, tuple) and series.dtype == object:
+            # A chunk that does not parse completely is kept as text
+            parsed = _parse_dates(series, target[1])
+            if parsed is not None:
+                series = parsed
+        else:
+            series = _downcast_numeric(series)
+        columns[col] = series
+    return columns
+
+
+def read_csv_compact(buffer, total_bytes=None, chunksize=CHUNK_ROWS, progress=None, **read_options):
+    """Read a CSV in chunks with compact dtypes; returns (df, IngestReport).
+
+    Each chunk is shrunk as soon as it is parsed and only the compact column
+    pieces are kept, so the default-dtype copy of the whole file never exists.
+    """
+    started = time.perf_counter()
+    plan = None
+    # Date columns with a chunk that did not parse: column -> format
+    text_dates = {}
+    parts = {}
+    default_bytes = 0
+    held_bytes = 0
+    peak_bytes = 0
+    rows = 0
+
+    for chunk in pd.read_csv(buffer, chunksize=chunksize, **read_options):
+        chunk_bytes = int(chunk.memory_usage(deep=True).sum())
+        default_bytes += chunk_bytes
+        if plan is None:
+            plan = _plan_compact_dtypes(chunk)
+        for col, series in _compact_chunk(chunk, plan).items():
+            if isinstance(plan.get(col), tuple) and series.dtype == object:
+                text_dates[col] = plan.pop(col)[1]
+            parts.setdefault(col, []).append(series.reset_index(drop=True))
+            held_bytes += int(series.memory_usage(deep=True, index=False))
+        peak_bytes = max(peak_bytes, held_bytes + chunk_bytes)
+        rows += len(chunk)
+        del chunk
+        if progress is not None and total_bytes:
+            progress(min(buffer.tell() / total_bytes, 1.0))
+
+    # Assemble column by column, releasing each column's pieces as we go
+    columns = {}
+    for col in list(parts):
+        pieces = parts.pop(col)
+        if col in text_dates:
+            # Like read_csv, the whole column stays text; parsed pieces format back exactly
+            pieces = [
+                piece.dt.strftime(text_dates[col]) if pd.api.types.is_datetime64_dtype(piece.dtype) else piece
+                for piece in pieces
+            ]
+        if all(isinstance(piece.dtype, pd.CategoricalDtype) for piece in pieces):
+            merged = pd.Series(union_categoricals(pieces), name=col)
+        else:
+            # Pieces may have been downcast to different widths
+            merged = _downcast_numeric(pd.concat(pieces, ignore_index=True))
+        merged_bytes = int(merged.memory_usage(deep=True, index=False))
+        peak_bytes = max(peak_bytes, held_bytes + merged_bytes)
+        held_bytes += merged_bytes - sum(int(piece.memory_usage(deep=True, index=False)) for piece in pieces)
+        columns[col] = merged
+        del pieces
+    # copy=False skips block consolidation, which would copy every column again
+    df = pd.DataFrame(columns, copy=False)
+
+    if progress is not None:
+        progress(1.0)
+    report = IngestReport(
+        rows, time.perf_counter() - started, default_bytes,
+        int(df.memory_usage(deep=True).sum()), peak_bytes
+    )
+    return df, report
+
+
+def load_csv(file, compact=None, progress=None, trace=None, **read_options):
+    """Parse an uploaded CSV, reusing the cached result for identical bytes.
+
+    `compact` defaults to chunked compact mode for uploads of at least
+    COMPACT_MIN_BYTES; `progress` is called with the fraction read so far.
+    An actual parse is recorded as a "read_csv" span on `trace`.
+    """
+    data = file.getvalue()
+    if compact is None:
+        compact = len(data) >= COMPACT_MIN_BYTES
+    key = content_hash(data, dict(read_options, compact=compact) if compact else read_options)
+    parsed = _cache.get(key)
+    if parsed is None:
+        report = None
+        # A previous process may already have converted the same bytes
+        handle = dataset_store.get(key)
+        if handle is None:
+            with perf.span(trace, "read_csv", file.name):
+                if compact:
+                    df, report = read_csv_compact(io.BytesIO(data), len(data), progress=progress, **read_options)
+                else:
+                    df = pd.read_csv(io.BytesIO(data), **read_options)
+                handle = dataset_store.put(key, df)
+                del df
+        parsed = ParsedCSV(handle, report)
+        _cache.put(key, parsed)
+    return IngestedFile(file.name, parsed)
+
+
+def parsed_for(handle):
+    """The shared cache entry of a stored dataset, recreated if it was evicted."""
+    parsed = _cache.peek(handle.content_hash)
+    if parsed is None:
+        parsed = ParsedCSV(handle)
+        _cache.put(handle.content_hash, parsed)
+    return parsed
+
+
+def retain(parsed):
+    """Put an entry still in use back into the cache, keeping its profile."""
+    if parsed.content_hash not in _cache:
+        _cache.put(parsed.content_hash, parsed)
+
+
+def forget(content_hash):
+    _cache.pop(content_hash)
+
+
+def get_profile(handle, trace=None):
+    """Profile of a stored dataset, reusing the ingestion cache entry."""
+    return parsed_for(handle).profile(trace)
+
+
+def cache_stats():
+    """Hit/miss counters for the ingestion cache."""
+    return _cache.stats()
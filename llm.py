@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Calls to the generative model, shared by both apps.
+
+All requests go through the process-wide `scheduler`, which bounds the
+requests in flight across every session on the server, keeps the rate
+under the API quota, retries quota and transient errors with backoff and
+coalesces identical prompts. Explanations can be streamed so the UI
+renders text as it arrives instead of waiting for the whole response.
+"""
+
+import hashlib
+import logging
+import time
+
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def generate_text(model, prompt, priority=scheduler.PRIORITY_CODE):
+    started = time.perf_counter()
+    # Identical prompts to the same model in flight share one upstream call
+    key = (id(model), hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest())
+    text = scheduler.default_scheduler().submit(key, lambda: model.generate_content(prompt).text, priority)
+    logger.info(
+        "Generated %d chars from a %d char prompt in %.2fs",
+        len(text), len(prompt), time.perf_counter() - started,
+    )
+    return text
+
+
+class TextStream:
+    """Streams response text chunk by chunk, timing the first and last chunk.
+
+    Iterate it to receive text as it arrives; afterwards `text` holds the
+    full response and `first_token_seconds` / `total_seconds` the latencies.
+    """
+
+    def __init__(self, model, prompt, priority=scheduler.PRIORITY_EXPLAIN):
+        self.model = model
+        self.prompt = prompt
+        self.priority = priority
+        self.parts = []
+        self.first_token_seconds = None
+        self.total_seconds = None
+
+    def __iter__(self):
+        started = time.perf_counter()
+        chunks = scheduler.default_scheduler().stream(
+            lambda: self.model.generate_content(self.prompt, stream=True), self.priority
+        )
+        for chunk in chunks:
+            text = chunk.text
+            if not text:
+                continue
+            if self.first_token_seconds is None:
+                self.first_token_seconds = time.perf_counter() - started
+            self.parts.append(text)
+            yield text
+        self.total_seconds = time.perf_counter() - started
+        logger.info(
+            "Streamed %d chars: first token %.2fs, total %.2fs",
+            len(self.text), self.first_token_seconds or 0.0, self.total_seconds,
+        )
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def timing_summary(self):
+        if self.total_seconds is None:
+            return ""
+        first = self.first_token_seconds if self.first_token_seconds is not None else self.total_seconds
+        return f"first token after {first:.2f}s, complete in {self.total_seconds:.2f}s"
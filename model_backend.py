@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Pluggable model backends for both apps.
+
+A backend is any object with `generate_content(prompt, stream=False)` that
+returns a response with `.text`, or with `stream=True` an iterable of such
+chunks, which is the interface of `genai.GenerativeModel` that `llm.py` uses.
+The backend is chosen with CHAT_WITH_DATA_MODEL_BACKEND:
+
+- "gemini" (default): Gemini through google-generativeai.
+- "stub": `StubModel`, a deterministic local model that replays recorded
+  code and explanation responses with configurable delays, so the pipeline
+  can be run and benchmarked offline.
+"""
+
+import json
+import os
+import time
+from dataclasses import dataclass
+
+BACKEND = os.environ.get("CHAT_WITH_DATA_MODEL_BACKEND", "gemini")
+GEMINI_MODEL = os.environ.get("CHAT_WITH_DATA_GEMINI_MODEL", "gemini-2.0-flash-lite")
+STUB_RESPONSES = os.environ.get("CHAT_WITH_DATA_STUB_RESPONSES")
+STUB_LATENCY_SECONDS = float(os.environ.get("CHAT_WITH_DATA_STUB_LATENCY", 0.0))
+STUB_CHUNK_SECONDS = float(os.environ.get("CHAT_WITH_DATA_STUB_CHUNK_DELAY", 0.0))
+
+# Both code prompts start with this line; anything else is an explanation
+CODE_PROMPT_MARKER = "Python code generator"
+
+DEFAULT_CODE = "ANSWER = df.describe()"
+DEFAULT_EXPLANATION = "This is a recorded explanation from the local stub model."
+
+
+@dataclass
+class StubResponse:
+    text: str
+
+
+@dataclass
+class Recording:
+    """Responses replayed when `question` appears in the prompt."""
+
+    question: str
+    code: str = DEFAULT_CODE
+    explanation: str = DEFAULT_EXPLANATION
+
+
+class StubModel:
+    """Deterministic stand-in for a generative model.
+
+    Code prompts get the recorded code, other prompts the recorded
+    explanation, for the first recording whose question occurs in the
+    prompt (the defaults otherwise). Each call waits `latency_seconds`
+    before the first chunk and `chunk_seconds` between streamed chunks of
+    `chunk_chars` characters.
+    """
+
+    def __init__(self, recordings=(), latency_seconds=STUB_LATENCY_SECONDS,
+                 chunk_seconds=STUB_CHUNK_SECONDS, chunk_chars=40):
+        self.recordings = list(recordings)
+        self.latency_seconds = latency_seconds
+        self.chunk_seconds = chunk_seconds
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Load recordings from a JSON list of {question, code, explanation}."""
+        with open(path, encoding="utf-8") as f:
+            recordings = [Recording(**item) for item in json.load(f)]
+        return cls(recordings, **kwargs)
+
+    def _respond(self, prompt):
+        recording = next((r for r in self.recordings if r.question and r.question in prompt), None)
+        is_code = CODE_PROMPT_MARKER in prompt
+        if recording is None:
+            return DEFAULT_CODE if is_code else DEFAULT_EXPLANATION
+        return recording.code if is_code else recording.explanation
+
+    def _chunks(self, text):
+        time.sleep(self.latency_seconds)
+        for start in range(0, len(text), self.chunk_chars):
+            if start:
+                time.sleep(self.chunk_seconds)
+            yield StubResponse(text[start:start + self.chunk_chars])
+
+    def generate_content(self, prompt, stream=False):
+        self.calls += 1
+        text = self._respond(prompt)
+        if stream:
+            return self._chunks(text)
+        time.sleep(self.latency_seconds)
+        return StubResponse(text)
+
+
+def create_model(secrets=None, backend=None):
+    """The configured model backend.
+
+    `secrets` is a mapping holding `gemini_api_key` (Streamlit's
+    `st.secrets`); it is only read for the Gemini backend.
+    """
+    backend = backend or BACKEND
+    if backend == "stub":
+        if STUB_RESPONSES:
+            return StubModel.from_file(STUB_RESPONSES)
+        return StubModel()
+    if backend == "gemini":
+        import google.generativeai as genai
+
+        genai.configure(api_key=secrets["gemini_api_key"])
+        return genai.GenerativeModel(GEMINI_MODEL)
+    raise ValueError(f"Unknown model backend: {backend!r}")
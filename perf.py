@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Lightweight per-stage timing for uploads and questions.
+
+A `RequestTrace` is created per upload or question and stages are wrapped
+in `trace.span(stage)`. Each span records wall time, CPU time of the
+calling thread, and how far the process's peak RSS grew while the span
+ran (`ru_maxrss`, so 0 means the stage stayed under an earlier peak).
+Generated code runs in a worker process, so its CPU time shows up in
+the "exec" wall time but not in its CPU time. The trace as a whole also
+records server CPU (`time.process_time`, all threads of the process)
+from creation to `finish()`.
+
+Finished traces go into a per-session `TraceBuffer` ring buffer and, when
+configured, to local exporters:
+
+- CHAT_WITH_DATA_PERF_JSONL: append one JSON line per trace.
+- CHAT_WITH_DATA_PERF_PROM: rewrite a Prometheus text-format file with
+  per-stage totals, e.g. for node_exporter's textfile collector.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+
+HISTORY_SIZE = int(os.environ.get("CHAT_WITH_DATA_PERF_HISTORY", 20))
+JSONL_PATH = os.environ.get("CHAT_WITH_DATA_PERF_JSONL")
+PROMETHEUS_PATH = os.environ.get("CHAT_WITH_DATA_PERF_PROM")
+
+# Pipeline stages in display order
+STAGES = ["read_csv", "describe", "sample", "prompt", "generate", "exec", "render", "explain"]
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+_MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+_export_lock = threading.Lock()
+# stage -> [count, wall seconds, cpu seconds] across all sessions
+_stage_totals = {}
+
+
+def _peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_SCALE
+
+
+@dataclass
+class Span:
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    peak_delta_bytes: int
+    detail: str = ""
+
+
+class RequestTrace:
+    """Spans of one upload or question; spans may come from several threads."""
+
+    def __init__(self, label, kind="question"):
+        self.label = label
+        self.kind = kind
+        self.started_at = time.time()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.spans = []
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, detail=""):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        peak = _peak_rss_bytes()
+        try:
+            yield
+        finally:
+            span = Span(
+                stage,
+                time.perf_counter() - wall,
+                time.thread_time() - cpu,
+                _peak_rss_bytes() - peak,
+                detail,
+            )
+            with self._lock:
+                self.spans.append(span)
+
+    def finish(self):
+        if self.wall_seconds is None:
+            self.wall_seconds = time.perf_counter() - self._started
+            self.cpu_seconds = time.process_time() - self._cpu_started
+
+    def stage_totals(self):
+        """stage -> summed wall/cpu seconds and the largest peak growth."""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span.stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_delta_bytes": 0})
+            total["wall_seconds"] += span.wall_seconds
+            total["cpu_seconds"] += span.cpu_seconds
+            total["peak_delta_bytes"] = max(total["peak_delta_bytes"], span.peak_delta_bytes)
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            spans = [asdict(span) for span in self.spans]
+        return {
+            "label": self.label,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "spans": spans,
+        }
+
+
+def span(trace, stage, detail=""):
+    """`trace.span(stage)`, or a no-op when there is no trace."""
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(stage, detail)
+
+
+class TraceBuffer:
+    """The last `size` finished traces of a session."""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.traces = deque(maxlen=size)
+
+    def record(self, trace):
+        """Finish a trace, keep it and export it; traces without spans are dropped."""
+        trace.finish()
+        if not trace.spans:
+            return
+        self.traces.append(trace)
+        export(trace)
+
+    def recent(self, count=None):
+        """Most recent traces first."""
+        traces = list(reversed(self.traces))
+        return traces[:count] if count else traces
+
+    def __len__(self):
+        return len(self.traces)
+
+
+def _write_prometheus(path):
+    lines = [
+        "# HELP chat_with_data_stage_seconds_total Wall time spent per pipeline stage.",
+        "# TYPE chat_with_data_stage_seconds_total counter",
+    ]
+    for stage, (_, wall, _) in sorted(_stage_totals.items()):
+        lines.append(f'chat_with_data_stage_seconds_total{{stage="{stage}"}} {wall:.6f}')
+    lines += [
+        "# HELP chat_with_data_stage_cpu_seconds_total CPU time spent per pipeline stage.",
+        "# TYPE chat_with_data_stage_cpu_seconds_total counter",
+    ]
+    for stage, (_, _, cpu) in sorted(_stage_totals.items()):
+        lines.append(f'chat_with_data_stage_cpu_seconds_total{{stage="{stage}"}} {cpu:.6f}')
+    lines += [
+        "# HELP chat_with_data_stage_spans_total Spans recorded per pipeline stage.",
+        "# TYPE chat_with_data_stage_spans_total counter",
+    ]
+    for stage, (count, _, _) in sorted(_stage_totals.items()):
+        lines.append(f'chat_with_data_stage_spans_total{{stage="{stage}"}} {count}')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    # Scrapers never see a half-written file
+    os.replace(tmp_path, path)
+
+
+def export(trace):
+    """Send a finished trace to the configured exporters, if any."""
+    if not (JSONL_PATH or PROMETHEUS_PATH):
+        return
+    with _export_lock:
+        if JSONL_PATH:
+            with open(JSONL_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        if PROMETHEUS_PATH:
+            for span in trace.spans:
+                total = _stage_totals.setdefault(span.stage, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += span.wall_seconds
+                total[2] += span.cpu_seconds
+            _write_prometheus(PROMETHEUS_PATH)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Token-budgeted prompts for code generation.
+
+The code prompt used to list every column plus two full sample rows, which
+on 400-column tables made every request huge and slow. Columns are now
+ranked against the question with a lexical index over column names and
+frequent values from the dataset profile, plus the columns the indexed data
+dictionary matches. The best matches get a compact type-and-stats line and
+their dictionary definition, the rest a bare name and dtype, and columns are
+added only while the prompt fits the token budget.
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+
+from caching import LRUCache
+from text_index import InvertedIndex
+
+TOKEN_BUDGET = int(os.environ.get("CHAT_WITH_DATA_PROMPT_TOKENS", 1500))
+# Rough size of a token; good enough to keep prompts under a budget
+CHARS_PER_TOKEN = 4
+# Share of the budget kept free for the sample rows
+SAMPLE_SHARE = 0.2
+MAX_CELL_CHARS = 40
+NAME_WEIGHT = 3
+
+logger = logging.getLogger(__name__)
+
+CODE_PROMPT = """
+You are a helpful Python code generator.
+Your goal is to write Python code snippets based on the user's question and the provided DataFrame information.
+Here's the context:
+**User Question:**
+{question}
+**DataFrame Name:**
+{df_name}
+**DataFrame Details:**
+{details}
+**Sample Data (Top 2 Rows):**
+{sample}
+
+**Instructions:**
+1. Write Python code that addresses the user's question by querying or manipulating the DataFrame.
+2. **Use the `exec()` function to execute the generated code.**
+3. Do not import pandas, but you may assume `pd` (pandas) is already available.
+4. Change date column type to datetime if needed.
+5. Store the result in a variable named `ANSWER`.
+6. Assume the DataFrame is already loaded into a pandas DataFrame object named `{df_name}`.
+7. Keep the generated code concise and focused on answering the question.
+8. If the question requires a specific output format (e.g., a list, a single value), ensure the `ANSWER` variable holds that format.
+"""
+
+EXAMPLE = """
+**Example:**
+If the user asks: "Show me the rows where the 'age' column is greater than 30."
+And the DataFrame has an 'age' column.
+The generated code should look something like this:
+```python
+ANSWER = {df_name}[{df_name}['age'] > 30]
+```
+"""
+
+SQL_PROMPT = """
+You are a helpful SQL generator for DuckDB.
+Write one SQL query that answers the user's question using the tables below.
+**User Question:**
+{question}
+**Tables:**
+{tables}
+
+**Instructions:**
+1. Return only a single SELECT (or WITH ... SELECT) statement, without explanations.
+2. Use DuckDB SQL. Quote identifiers that contain spaces, capitals or non-ASCII characters with double quotes.
+3. Join tables when the question spans several files.
+4. Aggregate in SQL rather than returning raw rows when the question asks for totals, averages or counts.
+5. Cast text columns to DATE or TIMESTAMP when the question needs dates.
+"""
+
+
+@dataclass
+class BuiltPrompt:
+    text: str
+    tokens: int
+    columns_shown: list
+    columns_total: int
+    matched_columns: list
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class ColumnIndex:
+    """Lexical index over one dataset's columns."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.index = InvertedIndex()
+        for column in profile.columns:
+            self.index.add(column.name, column.name, weight=NAME_WEIGHT)
+            if column.top:
+                self.index.add(column.name, " ".join(str(value) for value, _ in column.top))
+
+    def rank(self, question, dictionary=None):
+        """Matched columns best first, then the rest in file order.
+
+        Returns `(matched, rest, definitions)`, where definitions maps the
+        dictionary-matched columns to their description.
+        """
+        scores = dict(self.index.search(question))
+        definitions = {}
+        if dictionary is not None:
+            names = {column.name for column in self.profile.columns}
+            for entry, score in dictionary.lookup(question, columns=names):
+                scores[entry.column] = scores.get(entry.column, 0.0) + score
+                definitions[entry.column] = entry.describe()
+        matched = sorted(scores, key=scores.get, reverse=True)
+        matched_set = set(matched)
+        rest = [column.name for column in self.profile.columns if column.name not in matched_set]
+        return matched, rest, definitions
+
+
+_indexes = LRUCache(max_entries=32)
+
+
+def column_index(content_hash, profile):
+    """ColumnIndex for a dataset, cached by its content hash."""
+    index = _indexes.get(content_hash)
+    if index is None:
+        index = ColumnIndex(profile)
+        _indexes.put(content_hash, index)
+    return index
+
+
+def _cell(value):
+    text = "" if value is None else str(value)
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 1] + "…"
+
+
+def _sample_text(head_records, columns, rows=2):
+    lines = [" | ".join(columns)]
+    for record in head_records[:rows]:
+        lines.append(" | ".join(_cell(record.get(name)) for name in columns))
+    return "\n".join(lines)
+
+
+def _column_lines(question, index, dictionary, budget):
+    """Column lines for the prompt, best matches first, within `budget` tokens.
+
+    Returns `(lines, shown, matched, used)`.
+    """
+    profile = index.profile
+    matched, rest, definitions = index.rank(question, dictionary)
+    matched_set = set(matched)
+    columns = {column.name: column for column in profile.columns}
+    shown = []
+    lines = []
+    used = 0
+    for name in matched + rest:
+        column = columns[name]
+        if name in matched_set:
+            line = column.summary()
+        else:
+            line = f"- {name}: {column.dtype}"
+        if definitions.get(name):
+            line += f" — {definitions[name]}"
+        cost = estimate_tokens(line) + 1
+        # Always show at least one column, even on a tiny budget
+        if shown and used + cost > budget:
+            continue
+        shown.append(name)
+        lines.append(line)
+        used += cost
+
+    shown_set = set(shown)
+    omitted = [name for name in matched + rest if name not in shown_set]
+    if omitted:
+        note = f"({len(omitted)} more columns not shown: {', '.join(omitted)})"
+        if used + estimate_tokens(note) > budget:
+            note = f"({len(omitted)} more columns not shown)"
+        lines.append(note)
+        used += estimate_tokens(note)
+    return lines, shown, matched, used
+
+
+def build_code_prompt(question, index, df_name="df", include_example=True, token_budget=TOKEN_BUDGET,
+                      dictionary=None):
+    """Assemble the code-generation prompt within `token_budget` tokens.
+
+    `dictionary` is an optional `data_dictionary.DataDictionary`; only the
+    definitions of columns it matches for this question are included.
+    """
+    profile = index.profile
+    template = CODE_PROMPT + (EXAMPLE if include_example else "")
+    base_tokens = estimate_tokens(template.format(question=question, df_name=df_name, details="", sample=""))
+    remaining = token_budget - base_tokens
+    lines, shown, matched, used = _column_lines(question, index, dictionary, remaining * (1 - SAMPLE_SHARE))
+
+    # Sample rows for the shown columns, dropping columns until they fit
+    sample_columns = list(shown)
+    sample = _sample_text(profile.head_records, sample_columns)
+    while len(sample_columns) > 1 and used + estimate_tokens(sample) > remaining:
+        sample_columns.pop()
+        sample = _sample_text(profile.head_records, sample_columns)
+
+    text = template.format(question=question, df_name=df_name, details="\n".join(lines), sample=sample)
+    built = BuiltPrompt(text, estimate_tokens(text), shown, len(profile.columns), matched)
+    logger.info(
+        "Code prompt: ~%d tokens, %d/%d columns shown (%d matched the question)",
+        built.tokens, len(shown), built.columns_total, len(matched),
+    )
+    return built
+
+
+def build_sql_prompt(question, tables, token_budget=TOKEN_BUDGET, dictionary=None):
+    """Assemble the SQL-generation prompt over several tables.
+
+    `tables` is a list of `(table_name, file_name, ColumnIndex)`; the budget
+    is shared evenly and each table gets a sample row.
+    """
+    base_tokens = estimate_tokens(SQL_PROMPT.format(question=question, tables=""))
+    per_table = max(1, (token_budget - base_tokens) // max(1, len(tables)))
+    sections = []
+    shown_all = []
+    matched_all = []
+    columns_total = 0
+    for table_name, file_name, index in tables:
+        profile = index.profile
+        lines, shown, matched, used = _column_lines(
+            question, index, dictionary, per_table * (1 - SAMPLE_SHARE)
+        )
+        sample_columns = list(shown)
+        sample = _sample_text(profile.head_records, sample_columns, rows=1)
+        while len(sample_columns) > 1 and used + estimate_tokens(sample) > per_table:
+            sample_columns.pop()
+            sample = _sample_text(profile.head_records, sample_columns, rows=1)
+        sections.append(
+            f"Table `{table_name}` (from {file_name}, {profile.rows:,} rows):\n"
+            + "\n".join(lines) + f"\nSample:\n{sample}"
+        )
+        shown_all += [f"{table_name}.{name}" for name in shown]
+        matched_all += [f"{table_name}.{name}" for name in matched]
+        columns_total += len(profile.columns)
+
+    text = SQL_PROMPT.format(question=question, tables="\n\n".join(sections))
+    built = BuiltPrompt(text, estimate_tokens(text), shown_all, columns_total, matched_all)
+    logger.info(
+        "SQL prompt: ~%d tokens, %d tables, %d/%d columns shown (%d matched the question)",
+        built.tokens, len(tables), len(shown_all), columns_total, len(matched_all),
+    )
+    return built
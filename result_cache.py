@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Memoized results of executed analysis code.
+
+Results are keyed by a hash of the cleaned code plus the content hash of the
+dataset it ran on, and stored serialized: DataFrames as Arrow IPC streams,
+everything else pickled. A bounded in-memory tier spills evicted entries to
+a bounded on-disk tier. Keys include the dataset's content hash, so new
+contents under a known file name never hit stale entries; the old ones age
+out of the bounded tiers, and history references to them stay valid while
+they last.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+from caching import LRUCache
+
+CACHE_DIR = os.environ.get("CHAT_WITH_DATA_RESULT_CACHE", ".result_cache")
+MAX_MEMORY_BYTES = 256 * 1024**2
+MAX_DISK_BYTES = 2 * 1024**3
+
+MISSING = object()
+
+_ARROW = b"A"
+_PICKLE = b"P"
+
+
+def code_hash(code):
+    return hashlib.blake2b(code.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def serialize(value):
+    """Arrow IPC for DataFrames (falling back to pickle), pickle otherwise."""
+    if isinstance(value, pd.DataFrame):
+        try:
+            table = pa.Table.from_pandas(value)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return _ARROW + sink.getvalue().to_pybytes()
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+    return _PICKLE + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def deserialize(payload):
+    kind, body = payload[:1], payload[1:]
+    if kind == _ARROW:
+        return pa.ipc.open_stream(pa.py_buffer(body)).read_all().to_pandas()
+    return pickle.loads(body)
+
+
+class ResultCache:
+    def __init__(self, max_memory_bytes=MAX_MEMORY_BYTES, cache_dir=CACHE_DIR, max_disk_bytes=MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = LRUCache(max_entries=10_000, max_bytes=max_memory_bytes, sizeof=len, on_evict=self._spill)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, code, dataset_hash):
+        return f"{dataset_hash}-{code_hash(code)}"
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def get(self, code, dataset_hash):
+        """Return the cached ANSWER, or MISSING."""
+        key = self._key(code, dataset_hash)
+        payload = self._memory.get(key)
+        if payload is None:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    payload = f.read()
+                os.utime(path)
+                self._memory.put(key, payload)
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+        # Each caller gets its own copy, so cached results cannot be mutated
+        return deserialize(payload)
+
+    def put(self, code, dataset_hash, value):
+        key = self._key(code, dataset_hash)
+        try:
+            payload = serialize(value)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # Figures, generators and other unpicklable results are not cached
+            return
+        self._memory.put(key, payload)
+
+    def _spill(self, key, payload):
+        """Move an entry evicted from memory to the disk tier."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # `get` reads the disk tier without a lock, so a file appears only when complete
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, self._disk_path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            # Temp files belong to spills still being written
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        memory = self._memory.stats()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": memory["entries"],
+                "memory_bytes": memory["bytes"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_default_cache = ResultCache()
+
+
+def default_cache():
+    return _default_cache
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Bounded text digests of ANSWER values.
+
+The explanation prompt used to embed `str(ANSWER)`, which for a 100k-row
+frame is slow to build and far too large to send. `digest` describes any
+ANSWER in at most `max_tokens` tokens: shape and dtypes, the first and
+last rows, summary statistics of numeric columns and the most frequent
+values of text columns, with explicit markers wherever something was cut.
+Only the rows and columns that end up in the digest are ever formatted.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from prompt_builder import CHARS_PER_TOKEN
+
+EXPLAIN_TOKENS = int(os.environ.get("CHAT_WITH_DATA_DIGEST_TOKENS", 600))
+PREVIEW_TOKENS = 250
+HEAD_ROWS = 5
+TAIL_ROWS = 3
+MAX_COLUMNS = 12
+TOP_K = 5
+# Text columns whose frequent values are listed
+MAX_GROUP_COLUMNS = 3
+MAX_CELL_CHARS = 40
+MAX_ITEMS = 10
+TRUNCATED = "… (digest truncated)"
+
+
+def _cut(text, limit):
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    keep = max(0, limit - len(f"… (+{len(text):,} chars)"))
+    return f"{text[:keep]}… (+{len(text) - keep:,} chars)"
+
+
+def _cell(value):
+    if isinstance(value, float):
+        text = f"{value:.6g}"
+    else:
+        text = str(value)
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 1] + "…"
+
+
+def _rows_text(frame):
+    if not isinstance(frame.index, pd.RangeIndex):
+        frame = frame.reset_index(allow_duplicates=True)
+    # By position: a label can name several columns
+    shown = frame.iloc[:, :MAX_COLUMNS]
+    lines = [" | ".join(_cell(name) for name in shown.columns)]
+    for row in shown.itertuples(index=False, name=None):
+        lines.append(" | ".join(_cell(value) for value in row))
+    return "\n".join(lines)
+
+
+def _head_tail(frame):
+    rows = len(frame)
+    if rows <= HEAD_ROWS + TAIL_ROWS:
+        return [f"Rows:\n{_rows_text(frame)}"]
+    return [
+        f"First {HEAD_ROWS} rows:\n{_rows_text(frame.iloc[:HEAD_ROWS])}",
+        f"… ({rows - HEAD_ROWS - TAIL_ROWS:,} rows omitted)",
+        f"Last {TAIL_ROWS} rows:\n{_rows_text(frame.iloc[-TAIL_ROWS:])}",
+    ]
+
+
+def _numeric_stats(series):
+    values = series.dropna()
+    if values.empty:
+        return f"{series.name}: all missing"
+    return (
+        f"{series.name}: mean {_cell(float(values.mean()))}, min {_cell(values.min())}, "
+        f"max {_cell(values.max())}, sum {_cell(float(values.sum()))}"
+    )
+
+
+def _top_values(series):
+    counts = series.value_counts(dropna=False).head(TOP_K)
+    return f"{series.name}: " + ", ".join(f"{_cell(value)} ({count:,})" for value, count in counts.items())
+
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+
+def _frame_sections(frame):
+    rows, columns = frame.shape
+    dtypes = ", ".join(f"{name}: {dtype}" for name, dtype in frame.dtypes.iloc[:MAX_COLUMNS].items())
+    if columns > MAX_COLUMNS:
+        dtypes += f" … (+{columns - MAX_COLUMNS:,} more columns)"
+    sections = [f"DataFrame with {rows:,} rows and {columns:,} columns", f"Columns: {dtypes}"]
+    if rows == 0:
+        return sections
+    sections += _head_tail(frame)
+    # Summaries only add information once rows were omitted
+    if rows > HEAD_ROWS + TAIL_ROWS:
+        # By position: a label can name several columns
+        shown = [frame.iloc[:, position] for position in range(min(columns, MAX_COLUMNS))]
+        numeric = [series for series in shown if _is_numeric(series)]
+        if numeric:
+            sections.append("Numeric summary:\n" + "\n".join(_numeric_stats(series) for series in numeric))
+        text = [series for series in shown if not _is_numeric(series)][:MAX_GROUP_COLUMNS]
+        if text:
+            sections.append("Most frequent values:\n" + "\n".join(_top_values(series) for series in text))
+    return sections
+
+
+def _series_sections(series):
+    name = f" '{series.name}'" if series.name is not None else ""
+    sections = [f"Series{name} with {len(series):,} values of dtype {series.dtype}"]
+    if series.empty:
+        return sections
+    sections += _head_tail(series.to_frame(name=series.name if series.name is not None else "value"))
+    if len(series) > HEAD_ROWS + TAIL_ROWS:
+        if _is_numeric(series):
+            sections.append("Summary: " + _numeric_stats(series.rename("values")))
+        else:
+            sections.append("Most frequent values: " + _top_values(series.rename("values")))
+    return sections
+
+
+def _collection_sections(value):
+    kind = type(value).__name__
+    if isinstance(value, dict):
+        items = [f"{_cell(key)}: {_cell(item)}" for key, item in list(value.items())[:MAX_ITEMS]]
+    else:
+        items = [_cell(item) for item in list(value)[:MAX_ITEMS]]
+    sections = [f"{kind} with {len(value):,} items", "\n".join(items)]
+    if len(value) > MAX_ITEMS:
+        sections.append(f"… ({len(value) - MAX_ITEMS:,} more items)")
+    return sections
+
+
+def _sections(answer):
+    if isinstance(answer, pd.DataFrame):
+        return _frame_sections(answer)
+    if isinstance(answer, pd.Series):
+        return _series_sections(answer)
+    if isinstance(answer, pd.Index):
+        return _series_sections(pd.Series(answer))
+    if isinstance(answer, np.ndarray):
+        if answer.ndim == 1:
+            return _series_sections(pd.Series(answer))
+        return [f"Array of shape {answer.shape} and dtype {answer.dtype}", str(answer.ravel()[:MAX_ITEMS])]
+    if isinstance(answer, (list, tuple, set, frozenset, dict)):
+        return _collection_sections(answer)
+    return [str(answer)]
+
+
+def digest(answer, max_tokens=EXPLAIN_TOKENS):
+    """Describe `answer` in at most about `max_tokens` tokens."""
+    # Room is kept for the truncation marker, so the cap is never exceeded
+    max_chars = max_tokens * CHARS_PER_TOKEN - len(TRUNCATED) - 1
+    parts = []
+    used = 0
+    for section in _sections(answer):
+        if used + len(section) + 1 > max_chars:
+            remaining = max_chars - used - 1
+            # Keep a cut-down section if there is meaningful room for it
+            if remaining > 80 or not parts:
+                parts.append(_cut(section, max(remaining, 0)))
+            parts.append(TRUNCATED)
+            break
+        parts.append(section)
+        used += len(section) + 1
+    return "\n".join(parts)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Row samples of large datasets for progressive execution.
+
+On the largest uploads generated code can run for tens of seconds before
+anything is shown. Datasets of at least PROGRESSIVE_MIN_ROWS rows get a
+sample of SAMPLE_ROWS rows, built once at ingestion and stored in
+`dataset_store` like any other dataset, so worker processes open it
+memory-mapped and every question reuses it. Questions run on the sample
+first and show that result, labeled as approximate, while the full run
+continues.
+
+The sample is stratified on a low-cardinality text column when the profile
+has one, keeping every group of that column (at least one row each) in its
+original proportion; otherwise it is a uniform random sample. Row order is
+preserved in both cases.
+"""
+
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import dataset_store
+import ingestion
+import perf
+import worker_pool
+from caching import LRUCache
+
+PROGRESSIVE_MIN_ROWS = int(os.environ.get("CHAT_WITH_DATA_PROGRESSIVE_ROWS", 1_000_000))
+SAMPLE_ROWS = int(os.environ.get("CHAT_WITH_DATA_SAMPLE_ROWS", 100_000))
+# Columns with more distinct values than this are not used as strata
+MAX_STRATA = 50
+SEED = 0
+
+_samples = LRUCache(max_entries=64)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Sample:
+    handle: object
+    total_rows: int
+    strata: str = None
+
+    @property
+    def rows(self):
+        return self.handle.num_rows
+
+    def label(self):
+        kind = f"stratified by '{self.strata}'" if self.strata else "random"
+        return (
+            f"Approximate result from a {self.rows:,}-row {kind} sample of {self.total_rows:,} rows; "
+            "counts and sums are not scaled. The full result replaces it when ready."
+        )
+
+
+def strata_column(profile):
+    """The text-like column with the most groups, up to MAX_STRATA, or None."""
+    candidates = [
+        column for column in profile.columns
+        if 2 <= column.distinct <= MAX_STRATA and column.dtype in ("object", "category", "bool", "string")
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda column: column.distinct).name
+
+
+def sample_positions(df, rows, strata=None, seed=SEED):
+    """Sorted row positions of a sample of about `rows` rows."""
+    rng = np.random.default_rng(seed)
+    total = len(df)
+    rows = min(rows, total)
+    if not strata:
+        return np.sort(rng.choice(total, rows, replace=False))
+    codes, _ = pd.factorize(df[strata], use_na_sentinel=False)
+    # Random order within each group, groups laid out one after another
+    order = np.lexsort((rng.random(total), codes))
+    sizes = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    wanted = np.maximum(1, np.round(sizes * (rows / total))).astype(np.int64)
+    sorted_codes = codes[order]
+    rank = np.arange(total) - starts[sorted_codes]
+    return np.sort(order[rank < wanted[sorted_codes]])
+
+
+def _sample_key(content_hash):
+    return f"{content_hash}-sample{SAMPLE_ROWS}"
+
+
+def get_sample(handle):
+    """The stored sample of a dataset, or None if it has none (yet)."""
+    sample = _samples.get(handle.content_hash)
+    if sample is not None or handle.num_rows < PROGRESSIVE_MIN_ROWS:
+        return sample
+    # Built by an earlier process: the strata follow from the cached profile
+    stored = dataset_store.get(_sample_key(handle.content_hash))
+    if stored is None:
+        return None
+    sample = Sample(stored, handle.num_rows, strata_column(ingestion.get_profile(handle)))
+    _samples.put(handle.content_hash, sample)
+    return sample
+
+
+def ensure_sample(handle, trace=None):
+    """Build and store the sample of a large dataset once; None for small ones."""
+    if handle.num_rows < PROGRESSIVE_MIN_ROWS:
+        return None
+    sample = get_sample(handle)
+    if sample is None:
+        with perf.span(trace, "sample"):
+            strata = strata_column(ingestion.get_profile(handle))
+            df = dataset_store.open_dataframe(handle)
+            positions = sample_positions(df, SAMPLE_ROWS, strata)
+            stored = dataset_store.put(_sample_key(handle.content_hash), df.iloc[positions].reset_index(drop=True))
+        sample = Sample(stored, handle.num_rows, strata)
+        _samples.put(handle.content_hash, sample)
+    return sample
+
+
+def run_preview(pool, code, sample, df_name="df", job=None):
+    """`(ANSWER, stats)` of `code` on the sample, or None; errors are left to the full run."""
+    try:
+        local_vars, stats = pool.run(code, sample.handle, df_name, job=job)
+    except Exception as e:
+        logger.info("Sample run failed, waiting for the full run: %s", e)
+        return None
+    if "ANSWER" not in local_vars:
+        return None
+    return local_vars["ANSWER"], stats
+
+
+def start_preview(pool, code, sample, on_preview, df_name="df", trace=None, detail=""):
+    """Run `code` on the sample in a background thread, next to the caller's full run.
+
+    `on_preview(answer, stats)` is called from that thread when the sample
+    run produced an ANSWER. Returns the `worker_pool.Job` of the sample run:
+    cancel it once the full result is in, so it stops holding a worker.
+    """
+    job = worker_pool.Job()
+
+    def run():
+        with perf.span(trace, "exec", detail):
+            preview = run_preview(pool, code, sample, df_name, job)
+        if preview is not None and not job.cancelled:
+            on_preview(*preview)
+
+    threading.Thread(target=run, name="sample-preview", daemon=True).start()
+    return job
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Process-wide scheduling of model API requests.
+
+Every session used to call the model directly, limited only by a
+semaphore, with no retry: at peak the shared API key ran into its quota
+and the quota error reached the user as a generic failure. All requests
+from both apps now go through one `Scheduler`:
+
+- at most MAX_IN_FLIGHT requests run at once, admitted from a priority
+  queue (code and SQL generation before explanations, FIFO within a
+  priority);
+- a token bucket keeps the request rate under the quota (RATE_PER_MINUTE,
+  with bursts of up to BURST requests);
+- quota, rate-limit and transient server errors are retried with
+  exponential backoff and full jitter, and a quota error pauses the bucket
+  for every caller, not just the one that hit it;
+- identical prompts already in flight are coalesced, so the same question
+  on the same dataset from several analysts costs one upstream call.
+
+Queue depth, wait times, retries and coalesced requests are exposed
+through `stats()`. The scheduler has no thread of its own: callers wait
+on a condition variable until their ticket is admitted.
+"""
+
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+MAX_IN_FLIGHT = int(os.environ.get("CHAT_WITH_DATA_MAX_LLM_REQUESTS", 4))
+RATE_PER_MINUTE = float(os.environ.get("CHAT_WITH_DATA_LLM_RATE", 60))
+BURST = int(os.environ.get("CHAT_WITH_DATA_LLM_BURST", 10))
+MAX_RETRIES = int(os.environ.get("CHAT_WITH_DATA_LLM_RETRIES", 4))
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+# Wait times kept for the percentiles in stats()
+WAIT_SAMPLES = 500
+
+# Lower is served first
+PRIORITY_CODE = 0
+PRIORITY_EXPLAIN = 1
+
+_RETRYABLE_ERRORS = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError", "DeadlineExceeded",
+}
+_RATE_LIMIT_MARKERS = ("429", "quota", "rate limit", "resource exhausted", "resource_exhausted")
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceededError(RuntimeError):
+    """The API quota stayed exhausted through every retry; the message is user-facing."""
+
+
+def is_rate_limit(error):
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in _RATE_LIMIT_MARKERS)
+
+
+def is_retryable(error):
+    # Matched by name so the scheduler works with any client library
+    return type(error).__name__ in _RETRYABLE_ERRORS or is_rate_limit(error)
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `capacity`; rate <= 0 means unlimited."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a token is available; 0 when one is available now."""
+        if self.rate <= 0:
+            return 0.0
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+class Scheduler:
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, rate_per_minute=RATE_PER_MINUTE, burst=BURST,
+                 max_retries=MAX_RETRIES, base_backoff=BASE_BACKOFF_SECONDS, max_backoff=MAX_BACKOFF_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._pending = {}
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._counters = Counter()
+        self._max_depth = 0
+
+    @contextlib.contextmanager
+    def slot(self, priority=PRIORITY_CODE):
+        """Wait for admission by priority, in-flight bound and rate; hold it for the block."""
+        ticket = (priority, next(self._sequence))
+        enqueued = time.perf_counter()
+        with self._condition:
+            heapq.heappush(self._queue, ticket)
+            self._max_depth = max(self._max_depth, len(self._queue))
+            try:
+                while True:
+                    if self._queue[0] == ticket and self._in_flight < self.max_in_flight:
+                        delay = self._bucket.wait_time(time.monotonic())
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+            except BaseException:
+                # A stopped script must not leave its ticket blocking the queue
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._queue)
+            self._bucket.take()
+            self._in_flight += 1
+            self._waits.append(time.perf_counter() - enqueued)
+            # The next ticket may be admissible right away
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        with self._condition:
+            self._counters["retries"] += 1
+            if is_rate_limit(error):
+                self._counters["rate_limited"] += 1
+                self._bucket.pause(delay, time.monotonic())
+        logger.warning("Model request failed (%s), retrying in %.1fs", type(error).__name__, delay)
+        return delay
+
+    def _give_up(self, error):
+        with self._condition:
+            self._counters["failures"] += 1
+        if is_rate_limit(error):
+            raise QuotaExceededError(
+                "The model API quota is exhausted right now. Please try again in a minute."
+            ) from error
+        raise error
+
+    def call(self, fn, priority=PRIORITY_CODE):
+        """Run `fn()` in a slot, retrying transient and quota errors with backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.slot(priority):
+                    result = fn()
+                with self._condition:
+                    self._counters["requests"] += 1
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self._give_up(e)
+                delay = self._backoff(attempt, e)
+            time.sleep(delay)
+
+    def stream(self, open_stream, priority=PRIORITY_EXPLAIN):
+        """Yield from `open_stream()` in a slot; retried only until the first item arrives."""
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                with self.slot(priority):
+                    for item in open_stream():
+                        started = True
+                        yield item
+                with self._condition:
+                    self._counters["requests"] += 1
+                return
+            except Exception as e:
+                # Text already shown cannot be taken back
+                if started or not is_retryable(e) or attempt == self.max_retries:
+                    self._give_up(e)
+                delay = self._backoff(attempt, e)
+            time.sleep(delay)
+
+    def submit(self, key, fn, priority=PRIORITY_CODE):
+        """`call(fn)`, sharing the result with concurrent submits of the same key."""
+        with self._condition:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[key] = future
+            else:
+                self._counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            result = self.call(fn, priority)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("The shared request was cancelled."))
+            raise
+        finally:
+            with self._condition:
+                self._pending.pop(key, None)
+
+    def stats(self):
+        with self._condition:
+            waits = sorted(self._waits)
+            counters = dict(self._counters)
+            depth = len(self._queue)
+            in_flight = self._in_flight
+
+        def percentile(fraction):
+            return waits[min(len(waits) - 1, int(fraction * len(waits)))] if waits else 0.0
+
+        return {
+            "queue_depth": depth,
+            "max_queue_depth": self._max_depth,
+            "in_flight": in_flight,
+            "requests": counters.get("requests", 0),
+            "coalesced": counters.get("coalesced", 0),
+            "retries": counters.get("retries", 0),
+            "rate_limited": counters.get("rate_limited", 0),
+            "failures": counters.get("failures", 0),
+            "wait_p50_seconds": percentile(0.5),
+            "wait_p95_seconds": percentile(0.95),
+            "wait_max_seconds": waits[-1] if waits else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (
+            f"{stats['requests']} requests, {stats['in_flight']} in flight, {stats['queue_depth']} queued "
+            f"(max {stats['max_queue_depth']}); wait p50 {stats['wait_p50_seconds']:.2f}s / "
+            f"p95 {stats['wait_p95_seconds']:.2f}s; {stats['coalesced']} coalesced, "
+            f"{stats['retries']} retries ({stats['rate_limited']} rate-limited)"
+        )
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """The scheduler shared by every session in this process."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Scheduler()
+        return _default
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Optional SQL engine mode backed by an embedded DuckDB database.
+
+In the default mode each uploaded file is analyzed on its own as a pandas
+frame named `df`. In SQL mode every upload of the session is registered as
+a table and the model writes one SQL query for the question, so questions
+can join files. DuckDB scans the memory-mapped Arrow files from
+`dataset_store` directly with vectorized, multi-threaded operators and
+spills large joins and aggregations to disk past its memory limit, so
+neither the tables nor the intermediate results have to fit in pandas.
+
+Generated SQL must be a single read-only query; the connection has no
+access to external files and its configuration is locked. duckdb is an
+optional dependency: without it `available()` is False and the apps hide
+the mode.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import code_cache
+import dataset_store
+import ingestion
+import llm
+import perf
+import prompt_builder
+import result_cache
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+MEMORY_LIMIT = os.environ.get("CHAT_WITH_DATA_SQL_MEMORY", "2GB")
+THREADS = int(os.environ.get("CHAT_WITH_DATA_SQL_THREADS", os.cpu_count() or 1))
+TEMP_DIR = os.environ.get("CHAT_WITH_DATA_SQL_TEMP", ".duckdb_tmp")
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("CHAT_WITH_DATA_JOB_TIMEOUT", 120))
+# Rows fetched into pandas; the rest of a larger result is dropped
+MAX_RESULT_ROWS = 100_000
+
+_READ_ONLY = re.compile(r"^\s*(select|with|from)\b", re.IGNORECASE)
+_FENCE = re.compile(r"```(?:sql)?", re.IGNORECASE)
+
+_connection = None
+_connection_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class SQLError(RuntimeError):
+    """The generated query was rejected or failed; the message is user-facing."""
+
+
+@dataclass
+class QueryStats:
+    seconds: float
+    rows: int
+    truncated: bool
+
+    def summary(self):
+        text = f"DuckDB query in {self.seconds:.2f}s, {self.rows:,} rows"
+        if self.truncated:
+            text += f" (first {MAX_RESULT_ROWS:,} kept)"
+        return text
+
+
+@dataclass
+class SQLAnswer:
+    sql: str
+    answer: object
+    stats: QueryStats
+    dataset_hash: str
+
+
+def available():
+    return duckdb is not None
+
+
+def table_names(file_names):
+    """SQL-safe, unique table names for uploaded file names."""
+    names = []
+    for file_name in file_names:
+        base = re.sub(r"\.csv$", "", file_name, flags=re.IGNORECASE)
+        base = re.sub(r"\W+", "_", base).strip("_").lower() or "table"
+        if base[0].isdigit():
+            base = f"t_{base}"
+        name = base
+        suffix = 2
+        while name in names:
+            name = f"{base}_{suffix}"
+            suffix += 1
+        names.append(name)
+    return names
+
+
+def tables_hash(tables):
+    """Identity of a set of registered tables, for the result cache."""
+    digest = hashlib.blake2b(digest_size=16)
+    for name, handle in sorted(tables, key=lambda table: table[0]):
+        digest.update(f"{name}={handle.content_hash};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _get_connection():
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            os.makedirs(TEMP_DIR, exist_ok=True)
+            connection = duckdb.connect(":memory:")
+            connection.execute(f"SET memory_limit = '{MEMORY_LIMIT}'")
+            connection.execute(f"SET threads = {THREADS}")
+            connection.execute(f"SET temp_directory = '{TEMP_DIR}'")
+            # Generated SQL may not read or write files, nor change any of this
+            connection.execute("SET enable_external_access = false")
+            connection.execute("SET lock_configuration = true")
+            _connection = connection
+        return _connection
+
+
+def clean_sql(text):
+    return _FENCE.sub("", text).strip().rstrip(";").strip()
+
+
+def check_read_only(sql):
+    if not _READ_ONLY.match(sql) or ";" in sql:
+        raise SQLError("The generated SQL is not a single SELECT query and was not run.")
+
+
+def run_query(sql, tables, timeout=QUERY_TIMEOUT_SECONDS, max_rows=MAX_RESULT_ROWS):
+    """Run a read-only query over `tables` [(name, DatasetHandle)].
+
+    Returns `(DataFrame, QueryStats)`. Each query uses its own cursor, so
+    sessions can query concurrently with their own table names.
+    """
+    check_read_only(sql)
+    cursor = _get_connection().cursor()
+    timer = threading.Timer(timeout, cursor.interrupt)
+    started = time.perf_counter()
+    try:
+        for name, handle in tables:
+            # Zero-copy: DuckDB scans the memory-mapped Arrow table
+            cursor.register(name, dataset_store.open_table(handle))
+        timer.start()
+        df = cursor.sql(sql).limit(max_rows + 1).df()
+    except duckdb.InterruptException:
+        raise SQLError(f"The query took longer than {timeout:.0f}s and was stopped.")
+    except duckdb.Error as e:
+        raise SQLError(f"The SQL query failed: {e}")
+    finally:
+        timer.cancel()
+        cursor.close()
+
+    truncated = len(df) > max_rows
+    if truncated:
+        df = df.iloc[:max_rows]
+    stats = QueryStats(time.perf_counter() - started, len(df), truncated)
+    logger.info("Ran generated SQL: %s", stats.summary())
+    return df, stats
+
+
+def _schema_text(tables):
+    return "\n".join(
+        f"{name}: {dataset_store.open_table(handle).schema.to_string(show_schema_metadata=False)}"
+        for name, handle in tables
+    )
+
+
+def answer_question(question, files, model, dictionary=None, trace=None):
+    """Generate and run one SQL query over all uploaded `files` [(file name, handle)].
+
+    Generated SQL and query results are cached like generated pandas code.
+    """
+    names = table_names([file_name for file_name, _ in files])
+    tables = list(zip(names, [handle for _, handle in files]))
+    prompt_tables = []
+    for name, (file_name, handle) in zip(names, files):
+        profile = ingestion.get_profile(handle, trace)
+        prompt_tables.append((name, file_name, prompt_builder.column_index(handle.content_hash, profile)))
+
+    schema_fingerprint = code_cache.schema_fingerprint("duckdb\n" + _schema_text(tables))
+    sql = code_cache.default_cache().get(question, schema_fingerprint)
+    sql_from_cache = sql is not None
+    if not sql_from_cache:
+        with perf.span(trace, "prompt", "sql"):
+            prompt = prompt_builder.build_sql_prompt(question, prompt_tables, dictionary=dictionary).text
+        with perf.span(trace, "generate", "sql"):
+            sql = clean_sql(llm.generate_text(model, prompt))
+
+    dataset_hash = tables_hash(tables)
+    stats = None
+    answer = result_cache.default_cache().get(sql, dataset_hash)
+    if answer is result_cache.MISSING:
+        with perf.span(trace, "exec", "sql"):
+            answer, stats = run_query(sql, tables)
+        result_cache.default_cache().put(sql, dataset_hash, answer)
+    if not sql_from_cache:
+        code_cache.default_cache().put(question, schema_fingerprint, sql)
+    return SQLAnswer(sql, answer, stats, dataset_hash)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Tiny lexical index used to match questions against columns.
+
+Questions arrive in English and Thai. English text is split into words
+(with snake_case and camelCase names broken apart); Thai is written without
+spaces, so Thai runs are indexed as overlapping character trigrams, which
+matches Thai words inside longer phrases without a segmentation library.
+Documents are scored with BM25.
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+
+_WORD = re.compile(r"[^\W_]+", re.UNICODE)
+_THAI = re.compile(r"[\u0e00-\u0e7f]+")
+_CAMEL = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "by", "and", "or", "is", "are", "was", "what",
+    "which", "who", "how", "many", "much", "show", "me", "give", "list", "find", "with", "per", "each",
+    "from", "that", "this", "do", "does", "all", "top", "most", "least",
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _thai_grams(run):
+    if len(run) <= 3:
+        return [run]
+    return [run[i:i + 3] for i in range(len(run) - 2)]
+
+
+def tokenize(text):
+    """Lowercased word tokens plus Thai character trigrams."""
+    if not text:
+        return []
+    text = str(text)
+    tokens = []
+    for run in _THAI.findall(text):
+        tokens.extend(_thai_grams(run))
+    for word in _WORD.findall(_CAMEL.sub(" ", _THAI.sub(" ", text))):
+        word = word.lower()
+        if word not in STOPWORDS:
+            tokens.append(word)
+    return tokens
+
+
+class InvertedIndex:
+    """Token -> {doc id: term frequency} with BM25 ranking."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.doc_lengths = {}
+
+    def add(self, doc_id, text, weight=1):
+        self.add_tokens(doc_id, tokenize(text), weight)
+
+    def add_tokens(self, doc_id, tokens, weight=1):
+        for token, count in Counter(tokens).items():
+            self.postings[token][doc_id] = self.postings[token].get(doc_id, 0) + count * weight
+        self.doc_lengths[doc_id] = self.doc_lengths.get(doc_id, 0) + len(tokens) * weight
+
+    def search(self, query, limit=None):
+        """Return [(doc id, score)] best first; documents with no match are omitted."""
+        return self.search_tokens(tokenize(query), limit)
+
+    def search_tokens(self, tokens, limit=None):
+        if not self.doc_lengths:
+            return []
+        num_docs = len(self.doc_lengths)
+        average_length = sum(self.doc_lengths.values()) / num_docs or 1
+        scores = defaultdict(float)
+        for token in set(tokens):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit] if limit else ranked
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Prewarmed worker processes for generated analysis code.
+
+Generated code used to run with a bare `exec` on the Streamlit script
+thread, so one runaway `groupby().apply` froze the session and could take
+the whole server's memory with it. Jobs now run in a small pool of worker
+processes that have pandas imported already and open datasets from the
+memory-mapped `dataset_store`, so the data is shared through the page cache
+rather than copied into each worker. Every job has a wall-clock timeout, an
+anonymous-memory (RSS) limit and can be cancelled; a worker that hits any of
+these is killed and replaced.
+"""
+
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import dataset_store
+import execution
+
+POOL_SIZE = int(os.environ.get("CHAT_WITH_DATA_WORKERS", min(4, os.cpu_count() or 1)))
+JOB_TIMEOUT_SECONDS = float(os.environ.get("CHAT_WITH_DATA_JOB_TIMEOUT", 120))
+MAX_WORKER_RSS_BYTES = int(os.environ.get("CHAT_WITH_DATA_WORKER_RSS", 4 * 1024**3))
+POLL_SECONDS = 0.05
+
+
+class JobError(RuntimeError):
+    """A job was stopped or its worker failed; the message is user-facing."""
+
+
+class JobTimeout(JobError):
+    pass
+
+
+class JobMemoryExceeded(JobError):
+    pass
+
+
+class JobCancelled(JobError):
+    pass
+
+
+class RemoteError(JobError):
+    """The generated code raised inside the worker."""
+
+    def __init__(self, message, remote_traceback):
+        super().__init__(message)
+        self.remote_traceback = remote_traceback
+
+
+class Job:
+    """Handle for cancelling a running job from another thread."""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+def _worker_main(conn):
+    # pandas and pyarrow are imported with this module, once per worker
+    execution.enable_copy_on_write()
+    conn.send("ready")
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        code, handle, df_name = message
+        try:
+            df = dataset_store.open_dataframe(handle)
+            local_vars, stats = execution.run_code(code, df, df_name)
+            answer = {"ANSWER": local_vars["ANSWER"]} if "ANSWER" in local_vars else {}
+            conn.send(("ok", answer, stats))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc()))
+
+
+def _anon_rss_bytes(pid):
+    """Resident memory not backed by files (mapped datasets are excluded)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            fields = f.read().split()
+    except OSError:
+        # Not Linux or the process is gone: no limit can be enforced
+        return 0
+    return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE")
+
+
+class _Worker:
+    def __init__(self, context):
+        self._context = context
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = self._context.Pipe()
+        self.process = self._context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def restart(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.start()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class WorkerPool:
+    def __init__(self, size=POOL_SIZE, timeout=JOB_TIMEOUT_SECONDS, max_rss_bytes=MAX_WORKER_RSS_BYTES):
+        self.size = size
+        self.timeout = timeout
+        self.max_rss_bytes = max_rss_bytes
+        # spawn avoids forking the threaded Streamlit server
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(self._context) for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        atexit.register(self.shutdown)
+
+    def run(self, code, handle, df_name="df", timeout=None, max_rss_bytes=None, job=None):
+        """Execute generated code on a stored dataset in a worker.
+
+        Returns `(local_vars, stats)` like `execution.run_code`, where
+        local_vars only holds ANSWER. With a pool size of 0 the code runs
+        in-process instead.
+        """
+        if self.size == 0:
+            return execution.run_code(code, dataset_store.open_dataframe(handle), df_name)
+
+        timeout = timeout if timeout is not None else self.timeout
+        max_rss_bytes = max_rss_bytes if max_rss_bytes is not None else self.max_rss_bytes
+        worker = self._idle.get()
+        try:
+            # Cancelled while waiting for a worker: nothing to stop yet
+            if job is not None and job.cancelled:
+                raise JobCancelled("The analysis was cancelled.")
+            if not worker.ready:
+                try:
+                    worker.conn.recv()
+                except (EOFError, OSError):
+                    # Died during startup: the idle queue gets a fresh worker back
+                    worker.restart()
+                    raise JobError("The analysis worker failed to start.")
+                worker.ready = True
+            worker.conn.send((code, handle, df_name))
+            deadline = time.monotonic() + timeout
+            while not worker.conn.poll(POLL_SECONDS):
+                if job is not None and job.cancelled:
+                    worker.restart()
+                    raise JobCancelled("The analysis was cancelled.")
+                if time.monotonic() > deadline:
+                    worker.restart()
+                    raise JobTimeout(f"The analysis took longer than {timeout:.0f}s and was stopped.")
+                if max_rss_bytes and _anon_rss_bytes(worker.process.pid) > max_rss_bytes:
+                    worker.restart()
+                    raise JobMemoryExceeded(
+                        f"The analysis used more than {max_rss_bytes / 1024**3:.1f} GB of memory and was stopped."
+                    )
+                if not worker.process.is_alive():
+                    worker.restart()
+                    raise JobError("The analysis worker exited unexpectedly.")
+            try:
+                result = worker.conn.recv()
+            except EOFError:
+                worker.restart()
+                raise JobError("The analysis worker exited unexpectedly.")
+        finally:
+            self._idle.put(worker)
+
+        if result[0] == "error":
+            raise RemoteError(result[1], result[2])
+        _, local_vars, stats = result
+        return local_vars, stats
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.stop()